@@ -0,0 +1,323 @@
+# This package decides whether a new program can be launched.
+#
+# Admission keeps a count of the programs that are running in this server
+# process: a slot is taken before launching a program, and given back with
+# release() when its processes are finished. Both are constant-time,
+# whatever the number of sessions on the disk or in the database.
+#
+# The programs are in lanes, one per mode, each of which may only take a
+# share of the slots: this way, long proofs cannot take all the slots while
+# short runs wait.
+#
+# When no slot is available, programs submitted with submit() wait in the
+# queue of their lane, and are launched as slots are given back:
+#   - the next lane served is chosen in proportion to the weights of the
+#     lanes (stride scheduling)
+#   - in a lane, the program with the earliest arrival time plus expected
+#     duration goes first: short programs overtake long ones, but a long
+#     program is not overtaken by those which arrive more than its expected
+#     duration after it.
+#
+# The limit can be changed with set_limit(), as adaptive_limit does with
+# the capacity of the machine: the shares of the lanes follow it.
+
+import heapq
+import sys
+import time
+from threading import Thread, Lock
+
+RUNNING = "running"
+QUEUED = "queued"
+REJECTED = "rejected"
+# The possible results of Admission.submit
+
+DEFAULT_DURATION = 5.0
+# The number of seconds that a program is expected to take, before any
+# program has finished
+
+DURATION_WEIGHT = 0.1
+# The weight of the last program in the average duration
+
+MODE_DURATIONS = {"run": 2.0,
+                  "submit": 4.0,
+                  "prove": 10.0,
+                  "prove_flow": 5.0,
+                  "prove_report_all": 15.0}
+# The number of seconds that a program of each mode is expected to take,
+# for a program of REFERENCE_SIZE, before any such program has finished
+
+REFERENCE_SIZE = 10000
+# The size in bytes of the files of the program of MODE_DURATIONS
+
+MAX_HISTORY = 10000
+# The number of kinds of programs whose durations are remembered
+
+
+class Lane(object):
+
+    def __init__(self, name, weight, share, limit):
+        self.name = name
+        self.weight = weight
+        self.share = share    # the fraction of the slots the lane may take
+        self.limit = max(1, int(share * limit))  # the same in slots
+        self.in_flight = 0
+        self.queue = []       # heap of (key, sequence, identifier, launch,
+                              # cancelled)
+        self.pass_value = 0.  # the virtual time of the lane, which advances
+                              # by 1 / weight with each program launched
+
+
+class Admission(object):
+
+    def __init__(self, limit, queue_depth=0, lanes=None):
+        """limit is the number of programs that can be running at the
+           same time, queue_depth the number of programs that can wait
+           for a slot.
+           lanes maps the name of each lane to a pair (weight, share) where
+           share is the fraction of the slots that the lane may take. Other
+           lanes have a weight of 1 and may take all the slots.
+        """
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.in_flight = 0
+        self.queued = 0
+        self.lanes = {}
+        for name, (weight, share) in (lanes or {}).items():
+            self.lanes[name] = Lane(name, weight, share, limit)
+        self.pass_value = 0.  # the virtual time of the last lane served
+        self.sequence = 0
+        self.average_duration = DEFAULT_DURATION
+        self.lock = Lock()
+
+    def _lane(self, name):
+        if name not in self.lanes:
+            self.lanes[name] = Lane(name, 1, 1.0, self.limit)
+        return self.lanes[name]
+
+    def acquire(self, lane=None):
+        """Take a slot in the given lane. Return False if none is free."""
+        with self.lock:
+            l = self._lane(lane)
+            if self.in_flight >= self.limit or l.in_flight >= l.limit:
+                return False
+            self.in_flight += 1
+            l.in_flight += 1
+            return True
+
+    def submit(self, identifier, launch, lane=None, duration=None,
+               cancelled=None):
+        """Submit the program with the given identifier.
+           launch is called without arguments when the program gets a slot:
+           right away if one is free, otherwise when it is chosen from the
+           queue. It must arrange for release() to be called when the
+           program is finished, including when it fails to launch; if it
+           raises an exception, the slot is given back here.
+           lane is the lane of the program, and duration the number of
+           seconds it is expected to take.
+           cancelled, if given, is called without arguments instead of
+           launch if the program is removed from the queue with remove().
+           Return RUNNING, QUEUED, or REJECTED if the queue is full.
+        """
+        with self.lock:
+            l = self._lane(lane)
+            if self.in_flight < self.limit and l.in_flight < l.limit:
+                self.in_flight += 1
+                l.in_flight += 1
+            elif self.queued < self.queue_depth:
+                if not l.queue:
+                    # Do not let a lane which was idle catch up on the
+                    # others
+                    l.pass_value = max(l.pass_value, self.pass_value)
+                self.sequence += 1
+                key = time.time() + (duration or DEFAULT_DURATION)
+                heapq.heappush(l.queue, (key, self.sequence, identifier,
+                                         launch, cancelled))
+                self.queued += 1
+                return QUEUED
+            else:
+                return REJECTED
+
+        self._launch(identifier, launch, lane)
+        return RUNNING
+
+    def release(self, duration=None, lane=None):
+        """Give back a slot of the given lane, handing it over to the next
+           program in the queues if there is one.
+           duration is the number of seconds that the program took, if known.
+        """
+        with self.lock:
+            if duration is not None:
+                self.average_duration += (
+                    DURATION_WEIGHT * (duration - self.average_duration))
+
+            l = self._lane(lane)
+            if self.in_flight > 0:
+                self.in_flight -= 1
+            if l.in_flight > 0:
+                l.in_flight -= 1
+
+        self._launch_next()
+
+    def set_limit(self, limit):
+        """Change the number of programs that can be running at the same
+           time. If it grows, the programs in the queues get the new slots,
+           from a task of their own: this is called from the callbacks of
+           the programs, which must not be held up.
+        """
+        with self.lock:
+            grown = limit > self.limit
+            self.limit = limit
+            for l in self.lanes.values():
+                l.limit = max(1, int(l.share * limit))
+        if grown:
+            t = Thread(target=self._launch_queued)
+            t.daemon = True
+            t.start()
+
+    def _launch_queued(self):
+        """Launch the programs in the queues while there are free slots"""
+        while self._launch_next():
+            pass
+
+    def _launch_next(self):
+        """Launch the next program in the queues if a slot is free for it.
+           Return whether one was launched.
+        """
+        with self.lock:
+            # Serve the lane furthest behind among those which can take
+            # a slot
+            candidates = [c for c in self.lanes.values()
+                          if c.queue and c.in_flight < c.limit]
+            if not candidates or self.in_flight >= self.limit:
+                return False
+            l = min(candidates, key=lambda c: c.pass_value)
+            self.pass_value = l.pass_value
+            l.pass_value += 1. / l.weight
+
+            _, _, identifier, launch, _ = heapq.heappop(l.queue)
+            self.queued -= 1
+            self.in_flight += 1
+            l.in_flight += 1
+
+        self._launch(identifier, launch, l.name)
+        return True
+
+    def _launch(self, identifier, launch, lane):
+        """Call launch, which was given a slot of the lane: if it fails, the
+           slot is given back.
+        """
+        try:
+            launch()
+        except Exception:
+            print "error when launching {}:".format(identifier), \
+                sys.exc_info()
+            self.release(lane=lane)
+
+    def position(self, identifier):
+        """Return the position, starting at 1, of the given program in the
+           queue of its lane, None if it is not queued.
+        """
+        with self.lock:
+            for l in self.lanes.values():
+                for index, entry in enumerate(sorted(l.queue)):
+                    if entry[2] == identifier:
+                        return index + 1
+        return None
+
+    def remove(self, identifier):
+        """Remove the given program from the queue, calling its cancelled
+           function. Return False if it was not queued.
+        """
+        with self.lock:
+            entry = None
+            for l in self.lanes.values():
+                for index, queued in enumerate(l.queue):
+                    if queued[2] == identifier:
+                        entry = l.queue.pop(index)
+                        heapq.heapify(l.queue)
+                        break
+                if entry is not None:
+                    break
+            if entry is None:
+                return False
+            self.queued -= 1
+
+        cancelled = entry[4]
+        if cancelled:
+            cancelled()
+        return True
+
+    def queued_programs(self):
+        """Return the identifiers of the programs in the queue"""
+        with self.lock:
+            return [entry[2] for l in self.lanes.values()
+                    for entry in l.queue]
+
+    def estimated_wait(self, position=None):
+        """Return the estimated number of seconds before the program at
+           the given position in the queue gets a slot. By default, this
+           is for a program arriving at the end of the queue.
+        """
+        with self.lock:
+            if position is None:
+                position = self.queued + 1
+            wait = self.average_duration * position / self.limit
+        return int(round(wait)) or 1
+
+    def demand(self):
+        """Return the number of programs running or queued"""
+        with self.lock:
+            return self.in_flight + self.queued
+
+    def status(self):
+        """Return the state of the slots and of the queues, for display"""
+        with self.lock:
+            return {'limit': self.limit,
+                    'in_flight': self.in_flight,
+                    'queued': self.queued,
+                    'lanes': dict((l.name or "default",
+                                   {'limit': l.limit,
+                                    'in_flight': l.in_flight,
+                                    'queued': len(l.queue)})
+                                  for l in self.lanes.values())}
+
+
+def nominal_duration(mode, size):
+    """Return the number of seconds that a program of the given mode and
+       size of files is expected to take on an idle machine.
+    """
+    return MODE_DURATIONS.get(mode, DEFAULT_DURATION) * (
+        1 + float(size) / REFERENCE_SIZE)
+
+
+class CostModel(object):
+    """Estimates the duration of programs from their mode, the size of
+       their files, and the durations of the previous programs with the same
+       files names, which are those of the same example.
+    """
+
+    def __init__(self):
+        self.history = {}  # the average duration of each kind of program
+        self.lock = Lock()
+
+    def estimate(self, mode, names, size):
+        """Return the number of seconds that the program is expected to
+           take, given the names and total size of its files.
+        """
+        with self.lock:
+            known = self.history.get((mode, tuple(sorted(names))))
+        if known is not None:
+            return known
+        return nominal_duration(mode, size)
+
+    def record(self, mode, names, duration):
+        """Record the duration of a program, see estimate"""
+        key = (mode, tuple(sorted(names)))
+        with self.lock:
+            if key not in self.history:
+                if len(self.history) >= MAX_HISTORY:
+                    self.history.clear()
+                self.history[key] = duration
+            else:
+                self.history[key] += (
+                    DURATION_WEIGHT * (duration - self.history[key]))
@@ -0,0 +1,369 @@
+# This package contains the backends which run the programs.
+#
+# A backend runs the program of a session dir, and writes its output and
+# status in the session dir as SeparateProcess does, so that the clients
+# read it with the identifier of the session whatever the backend:
+#
+#   LocalBackend runs the programs in the containers of this machine.
+#
+#   RemoteBackend sends the programs to a worker, that is a server on
+#   another machine running the management command run_worker, and relays
+#   their output. The protocol is that of the agent in the containers (see
+#   infrastructure/container_payload/agent.py), over TCP.
+#
+# The jobs sent to the workers carry the secret shared by the servers and
+# the workers, EXECUTION_SECRET, without which the workers refuse them.
+#
+# The Dispatcher chooses the backend of each program: the least loaded one,
+# or the one given by a consistent hash of the fingerprint of the program,
+# which sends identical programs to the same worker, and so to its caches.
+# A backend which cannot be reached is left out for a time which doubles
+# with each failure, up to MAX_BACKOFF, and its programs go to another.
+
+import bisect
+import codecs
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tarfile
+import time
+from abc import ABCMeta, abstractmethod
+from threading import Thread, Lock
+
+from compile_server.app.models import ProgramRun
+from compile_server.app import process_handling, container_agent, containers
+from compile_server.app.admission import nominal_duration
+
+USE_CONTAINER_AGENT = True
+# Whether to run programs through the agent in the container, when it is
+# set up, rather than with one lxc exec per program
+
+SESSION_ARCHIVE = "session.tar"
+# The archive of the session files sent to the container
+
+WORKERS = os.environ.get("EXECUTION_WORKERS", "").split()
+# The addresses, as host:port, of the workers to which the programs are
+# sent; if there are none, the programs are run on this machine
+
+SECRET = os.environ.get("EXECUTION_SECRET", "")
+# The secret shared by the servers and the workers, see above
+
+LEAST_LOADED = "least_loaded"
+CONSISTENT_HASH = "consistent_hash"
+# The policies of the Dispatcher
+
+DISPATCH_POLICY = os.environ.get("EXECUTION_DISPATCH", LEAST_LOADED)
+# The policy by which the programs are dispatched to the workers
+
+VIRTUAL_NODES = 64
+# The number of points of each backend on the ring of the consistent hash
+
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# The numbers of seconds for which a backend which cannot be reached is
+# left out, after its first failure and at most
+
+KILL_SESSION_CMD = (
+    "pkill -KILL -f '^python /workspace/run.py {0} '; "
+    "for p in /proc/[0-9]*; do "
+    "case $(readlink $p/cwd) in {0}|{0}/*) kill -KILL ${{p#/proc/}} ;; esac; "
+    "done")
+# The shell command, run in the container, which kills the processes of
+# the session in the given dir: run.py, and those running in the dir
+
+
+def session_files(tempd):
+    """Return the files in tempd, in the format of the received json"""
+    files = []
+    for name in sorted(os.listdir(tempd)):
+        if not os.path.isfile(os.path.join(tempd, name)):
+            continue
+        with codecs.open(os.path.join(tempd, name), 'r', 'utf-8') as f:
+            files.append({'basename': name, 'contents': f.read()})
+    return files
+
+
+def kill_in_container(container, tempd):
+    """Kill, in the background, the processes of the session tempd in the
+       given container.
+    """
+    command = ["lxc", "exec", container.name, "--", "sh", "-c",
+               KILL_SESSION_CMD.format(
+                   "/workspace/sessions/" + os.path.basename(tempd))]
+    t = Thread(target=subprocess.call, args=(command,))
+    t.daemon = True
+    t.start()
+
+
+def once(function):
+    """Return a function which calls function the first time it is called,
+       and does nothing the following times.
+    """
+    lock = Lock()
+    called = []
+
+    def call(*args, **kwargs):
+        with lock:
+            if called:
+                return
+            called.append(True)
+        function(*args, **kwargs)
+
+    return call
+
+
+def make_session_archive(tempd, archive):
+    """Create the tar archive of the files in tempd, with the name of
+       tempd as their directory, and readable and executable by everyone.
+    """
+    names = [name for name in os.listdir(tempd)
+             if os.path.isfile(os.path.join(tempd, name))]
+    with tarfile.open(archive, 'w') as tar:
+        root = tarfile.TarInfo(os.path.basename(tempd))
+        root.type = tarfile.DIRTYPE
+        root.mode = 0755
+        root.mtime = time.time()
+        tar.addfile(root)
+        for name in names:
+            info = tar.gettarinfo(os.path.join(tempd, name),
+                                  os.path.join(root.name, name))
+            info.mode |= 0555
+            info.uname = info.gname = ""
+            with open(os.path.join(tempd, name), 'rb') as f:
+                tar.addfile(info, f)
+
+
+class Unreachable(Exception):
+    """Raised when a backend cannot be reached: nothing was launched"""
+
+
+class Backend(object):
+    """The base of the backends, which define start()"""
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = 0  # the number of programs running on it
+        self.failures = 0   # the number of times in a row that it could
+                            # not be reached
+        self.down_until = 0  # the time until which it is left out
+        self.lock = Lock()
+
+    def up(self, now):
+        """Return whether the backend is not left out at the given time"""
+        with self.lock:
+            return now >= self.down_until
+
+    def launch(self, tempd, mode, lab, on_finish):
+        """Launch the program in the session dir tempd.
+           on_finish is called once the program is finished, or with False
+           if it could not be launched, in which case the failure is
+           recorded in tempd. Its keyword argument interrupted is whether
+           the program was stopped before its end, see SeparateProcess.
+           If the backend cannot be reached, raise Unreachable instead,
+           without calling on_finish: the program can go to another.
+        """
+        with self.lock:
+            self.in_flight += 1
+
+        def finish(launched=True, interrupted=False):
+            with self.lock:
+                self.in_flight -= 1
+            on_finish(launched, interrupted=interrupted)
+
+        finish = once(finish)
+        try:
+            self.start(tempd, mode, lab, finish)
+        except Unreachable:
+            print "backend {} cannot be reached".format(self.name)
+            with self.lock:
+                self.in_flight -= 1
+                self.down_until = time.time() + min(
+                    MAX_BACKOFF, MIN_BACKOFF * 2 ** min(self.failures, 16))
+                self.failures += 1
+            raise
+        except Exception, exception:
+            print "error when launching {} on {}:".format(tempd, self.name), \
+                sys.exc_info()
+            finish(False)
+            try:
+                process_handling.record_failure(tempd, str(exception))
+            except IOError:
+                # The session is gone
+                pass
+        else:
+            with self.lock:
+                self.failures = 0
+
+    @abstractmethod
+    def start(self, tempd, mode, lab, on_finish):
+        """Launch the program, see launch(). on_finish may be called
+           several times, only the first call counts. If the program could
+           not be launched, raise an exception, the failure is then recorded
+           by launch(), or Unreachable if the backend could not be reached.
+        """
+
+
+class LocalBackend(Backend):
+    """The backend running the programs in the containers of this machine"""
+
+    def start(self, tempd, mode, lab, on_finish):
+        start = time.time()
+        nominal = nominal_duration(mode, sum(
+            os.path.getsize(os.path.join(tempd, name))
+            for name in os.listdir(tempd)
+            if os.path.isfile(os.path.join(tempd, name))))
+        container = containers.pool.acquire()
+
+        def finish(launched=True, interrupted=False):
+            # The duration of an interrupted program tells nothing of the
+            # speed of the container
+            containers.pool.release(
+                container, (time.time() - start) / nominal
+                if launched and not interrupted else None)
+            on_finish(launched, interrupted=interrupted)
+
+        finish = once(finish)
+        try:
+            self.run_in(container, tempd, mode, lab, finish)
+        except Exception:
+            # The container is given back here, see start() for the rest
+            finish(False)
+            raise
+
+    def run_in(self, container, tempd, mode, lab, on_finish):
+        """Launch the program in the given container"""
+        if USE_CONTAINER_AGENT and container_agent.available(
+                container.agent_socket):
+            # The agent receives the files along with the job
+            job = {'identifier': os.path.basename(tempd),
+                   'files': session_files(tempd),
+                   'mode': mode,
+                   'lab': lab}
+            try:
+                p = container_agent.AgentJob(
+                    job, tempd, container.agent_socket, on_finish=on_finish)
+            except socket.error:
+                # The agent went away since it was probed
+                container_agent.set_unavailable(container.agent_socket)
+            else:
+                ProgramRun(working_dir=p.working_dir).save()
+                return
+
+        # The session is sent to the container as an archive on the standard
+        # input of the command which runs it: extracting it as "runner" gives
+        # the files the right owner in the same round-trip.
+        archive = os.path.join(tempd, SESSION_ARCHIVE)
+        make_session_archive(tempd, archive)
+
+        # Run the command(s) to check the program
+        run_cmd = ("tar -x -p -C /workspace/sessions -f - && "
+                   "python /workspace/run.py /workspace/sessions/{} {}").format(
+                       os.path.basename(tempd), mode)
+
+        if lab is not None:
+            run_cmd += " {}".format(lab)
+
+        commands = [
+                # Run the program
+                ["lxc", "exec", container.name, "--", "su", "runner",
+                 "-c",
+                 run_cmd]
+            ]
+
+        print "\n".join(" ".join(c) for c in commands)
+
+        p = process_handling.SeparateProcess(
+            commands, tempd, on_finish=on_finish, stdin_file=archive,
+            on_kill=lambda: kill_in_container(container, tempd))
+        stored_run = ProgramRun(working_dir=p.working_dir)
+        stored_run.save()
+
+
+class RemoteBackend(Backend):
+    """The backend sending the programs to a worker"""
+
+    def __init__(self, address):
+        """address is that of the worker, as host:port"""
+        super(RemoteBackend, self).__init__(address)
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+
+    def start(self, tempd, mode, lab, on_finish):
+        job = {'identifier': os.path.basename(tempd),
+               'files': session_files(tempd),
+               'mode': mode,
+               'lab': lab,
+               'secret': SECRET}
+        try:
+            p = container_agent.AgentJob(job, tempd, self.address,
+                                         on_finish=on_finish)
+        except socket.error, exception:
+            raise Unreachable(str(exception))
+        ProgramRun(working_dir=p.working_dir).save()
+
+
+def ring_hash(key):
+    """Return the position of key on the ring of the consistent hash"""
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class Dispatcher(object):
+
+    def __init__(self, backends, policy=LEAST_LOADED):
+        self.backends = backends
+        self.policy = policy
+
+        # The ring of the consistent hash: each backend has several points
+        # on it, and a key goes to the backend of the next point
+        self.ring = sorted((ring_hash("{}#{}".format(b.name, i)), b)
+                           for b in backends for i in range(VIRTUAL_NODES))
+        self.points = [point for point, _ in self.ring]
+
+    def choose(self, key=None, exclude=()):
+        """Return the backend for the program with the given key, which is
+           its fingerprint if known, other than those in exclude. Return
+           None if there is none.
+        """
+        now = time.time()
+        candidates = [b for b in self.backends
+                      if b not in exclude and b.up(now)]
+        if not candidates:
+            # The backends left out may be back: try them rather than fail
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+
+        if self.policy == CONSISTENT_HASH and key is not None:
+            # The first backend of the ring which is a candidate
+            index = bisect.bisect(self.points, ring_hash(key))
+            for offset in range(len(self.ring)):
+                backend = self.ring[(index + offset) % len(self.ring)][1]
+                if backend in candidates:
+                    return backend
+
+        return min(candidates, key=lambda b: b.in_flight)
+
+    def launch(self, tempd, mode, lab, on_finish, key=None):
+        """Launch the program in tempd, see Backend.launch, on the backend
+           chosen for it, or on another if this one cannot be reached.
+           Raise Unreachable if none can.
+        """
+        tried = []
+        while True:
+            backend = self.choose(key, tried)
+            if backend is None:
+                raise Unreachable("no backend can be reached")
+            try:
+                backend.launch(tempd, mode, lab, on_finish)
+                return
+            except Unreachable:
+                tried.append(backend)
+
+
+dispatcher = Dispatcher([RemoteBackend(w) for w in WORKERS] or
+                        [LocalBackend("local")],
+                        DISPATCH_POLICY)
@@ -31,58 +31,246 @@
 import glob
 import os
 import codecs
-import distutils.spawn
+import fcntl
 import json
+import multiprocessing
+import re
 import shutil
-import subprocess
+import sys
 import tempfile
+import time
+from threading import Thread, Lock, BoundedSemaphore, Event
 
+from django.conf import settings
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
-from compile_server.app.models import Resource, Example, ProgramRun
-from compile_server.app import process_handling
+from compile_server.app.models import Resource, Example, ProgramRun, \
+    ToolOutput
+from compile_server.app import process_handling, coalescing, backends, \
+    containers
+from compile_server.app.admission import Admission, CostModel, REJECTED, \
+    nominal_duration
+from compile_server.app.coalescing import Coalescer
+from compile_server.app.concurrency import AdaptiveLimit
+from compile_server.app.throttling import RateLimiter, FairShare, client_of, \
+    LOCAL_ADDRESSES
 from compile_server.app.views import CrossDomainResponse
 
-gnatprove_found = False
+PROCESSES_LIMIT = 300
+# The most programs that can be running: the actual limit is adapted to the
+# capacity of the machine below it, see adaptive_limit
 
-PROCESSES_LIMIT = 300  # The limit of processes that can be running
+MAX_PROCESSES_LIMIT = PROCESSES_LIMIT if backends.WORKERS else min(
+    PROCESSES_LIMIT, containers.AGENT_POOL_SIZE * len(containers.CONTAINERS))
+# The same, when the programs run on this machine: no more than the agents
+# of its containers run at the same time, lest the others time out waiting
+# for a worker of an agent
+
+MIN_PROCESSES_LIMIT = 8
+# The fewest programs that can be running, however loaded the machine
+
+INITIAL_PROCESSES_LIMIT = min(MAX_PROCESSES_LIMIT,
+                              4 * multiprocessing.cpu_count())
+# The limit of programs that can be running, until it is adapted
+
+QUEUE_DEPTH = 300  # The limit of programs that can wait for a slot
+
+LANES = {"run": (4, 1.0),
+         "submit": (2, 1.0),
+         "prove": (1, 0.4),
+         "prove_flow": (1, 0.2),
+         "prove_report_all": (1, 0.2)}
+# For each mode, the weight of its lane in the queue, and the share of the
+# slots that its programs can take: the proofs cannot take all the slots
+
+admission = Admission(INITIAL_PROCESSES_LIMIT, QUEUE_DEPTH, LANES)
+# The count of the programs running in this server process, and the queues
+# of those waiting for a slot
+
+cost_model = CostModel()
+# The expected durations of the programs, by which they are queued
+
+COALESCE_MODES = {"run": False,
+                  "submit": False,
+                  "prove": True,
+                  "prove_flow": True,
+                  "prove_report_all": True}
+# For each mode, whether a program identical to one in flight shares its
+# run: only for the modes whose output cannot depend on the time of the run,
+# or on anything else than the files
+
+coalescer = Coalescer()
+# The programs in flight that identical programs can share
+
+USE_PRECOMPUTED_OUTPUTS = True
+# Whether to serve the outputs precomputed for the unmodified examples, see
+# precompute_output
+
+SUBMISSION_RATE = 1
+SUBMISSION_BURST = 20
+# The number of programs per second that a client can submit in the long
+# run, and at once
+
+POLL_RATE = 20
+POLL_BURST = 100
+# The same for the requests for the output of programs
+
+submissions = RateLimiter(SUBMISSION_RATE, SUBMISSION_BURST)
+polls = RateLimiter(POLL_RATE, POLL_BURST)
+
+FAIR_SHARE_MINIMUM = 10
+# The number of programs that a client can always have running or queued
+
+fair_share = FairShare(INITIAL_PROCESSES_LIMIT + QUEUE_DEPTH,
+                       FAIR_SHARE_MINIMUM)
+# The programs of each client: a client cannot take more than its share of
+# the slots and of the queue
+
+
+def set_processes_limit(limit):
+    """Change the limit of programs that can be running"""
+    admission.set_limit(limit)
+    fair_share.set_capacity(limit + QUEUE_DEPTH)
+
+
+adaptive_limit = AdaptiveLimit(INITIAL_PROCESSES_LIMIT, MIN_PROCESSES_LIMIT,
+                               MAX_PROCESSES_LIMIT, set_processes_limit,
+                               host_load=not backends.WORKERS)
+# The limit of programs that can be running, from the durations of the
+# programs, and from the load of this machine if the programs run on it
 
 RECEIVED_FILE_CHAR_LIMIT = 50 * 1000
 # The limit in number of characters of files to accept
 
+WAIT_OUTPUT_SECONDS = 20
+# The maximum number of seconds that wait_output holds a request
 
-def check_gnatprove():
-    """Check that gnatprove is found on the PATH"""
-    # Do the check once, for performance
-    global gnatprove_found
-    if gnatprove_found:
-        return True
-    gnatprove_found = distutils.spawn.find_executable("gnatprove")
-    return gnatprove_found
+MAX_WAITING_REQUESTS = 32
+# The number of requests that wait_output may hold at the same time, each
+# holding a thread of the server: it must leave threads to the other
+# requests (see the README). Past it, wait_output answers right away.
 
+ABANDON_SECONDS = 15
+# Number of seconds after which a program whose output no client has asked
+# for is cancelled
 
-def resources_available():
-    """Return whether we have enough resources on the machine"""
-    if len(ProgramRun.objects.all()) > PROCESSES_LIMIT:
-        # We're over the limit: first attempt a cleanup
-        process_handling.cleanup_old_processes()
-        return len(ProgramRun.objects.all()) <= PROCESSES_LIMIT
-    else:
-        return True
+ABANDON_CHECK_INTERVAL = 5
+# Number of seconds between two looks for abandoned programs
 
+IDENTIFIER_PATTERN = re.compile(r'^\w+\Z')
+# The identifiers of the sessions, that is the names of their dirs
 
-@api_view(['POST'])
-def check_output(request):
-    """Check the output of a running process."""
-    received_json = json.loads(request.body)
-    identifier = received_json['identifier']
+SERVER_LOCK = os.path.join(settings.BASE_DIR, "compile_server.lock")
+# The file locked by the process which serves the programs: their slots,
+# queues and clients are in its memory, so there must be only one. It is
+# next to the database, where other users cannot take the lock first.
 
-    p = process_handling.ProcessReader(
-        os.path.join(tempfile.gettempdir(), identifier))
+canceller_lock = Lock()
+canceller_started = False
 
-    print received_json['already_read']
-    lines = p.read_lines(received_json['already_read'])
+waiting_requests = BoundedSemaphore(MAX_WAITING_REQUESTS)
+
+server_lock = Lock()
+server_lock_file = None
+
+
+def not_serving():
+    """Make this process the one which serves the programs if there is
+       none. If there is another, return the response to give.
+    """
+    global server_lock_file
+    with server_lock:
+        if server_lock_file is None:
+            f = open(SERVER_LOCK, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                print "another process serves the programs: the server " \
+                    "must be run in a single process"
+                return CrossDomainResponse(
+                    {'identifier': '',
+                     'message': "the server is misconfigured"},
+                    status=503)
+            server_lock_file = f
+    return None
+
+
+def too_many_requests(retry_after):
+    """Return the response to a client which has exceeded its limits"""
+    return CrossDomainResponse(
+        {'identifier': '',
+         'message': "too many requests",
+         'retry_after': retry_after},
+        headers={'Retry-After': str(retry_after)},
+        status=429)
+
+
+def bad_request(message):
+    """Return the response to a request which does not make sense"""
+    return CrossDomainResponse({'identifier': '', 'message': message},
+                               status=400)
+
+
+def invalid_identifier(received_json):
+    """Return the message for the client if the identifier that it gives is
+       not that of a session. Otherwise return None.
+    """
+    identifier = received_json.get('identifier')
+    if not isinstance(identifier, basestring) or \
+            not IDENTIFIER_PATTERN.match(identifier):
+        return "invalid identifier"
+    return None
+
+
+def invalid_position(received_json):
+    """Return the message for the client if the position in the output
+       that it gives, as a cursor or a number of lines already read, is
+       not one. Otherwise return None.
+    """
+    for key in ('cursor', 'already_read'):
+        value = received_json.get(key)
+        if value is not None and (
+                isinstance(value, bool) or
+                not isinstance(value, (int, long)) or value < 0):
+            return "invalid {}".format(key)
+    return None
+
+
+def invalid_timeout(received_json):
+    """Return the message for the client if the timeout that it gives is
+       not a number of seconds. Otherwise return None.
+    """
+    value = received_json.get('timeout', WAIT_OUTPUT_SECONDS)
+    if isinstance(value, bool) or \
+            not isinstance(value, (int, long, float)) or not value >= 0:
+        return "invalid timeout"
+    return None
+
+
+def output_response(p, received_json):
+    """Return the response giving the new output of the process read by p"""
+    position = admission.position(
+        coalescing.resolve(received_json['identifier']))
+    if position is not None:
+        # The program is waiting for a slot: tell the client how long for
+        return CrossDomainResponse({'output_lines': [],
+                                    'cursor': received_json.get('cursor'),
+                                    'status': 0,
+                                    'completed': False,
+                                    'message': "queued",
+                                    'queue_position': position,
+                                    'estimated_wait':
+                                        admission.estimated_wait(position)})
+
+    if 'cursor' in received_json:
+        # The client reads from the position we gave it last time
+        lines, cursor = p.read_from(received_json['cursor'] or 0)
+    else:
+        # Older clients count the lines that they have already read
+        lines = p.read_lines(received_json['already_read'])
+        cursor = None
 
     # Remove some noise from the gnatprove output
     lines = [l.strip() for l in lines if not l.startswith("Summary logged")]
@@ -91,17 +279,206 @@ def check_output(request):
     if returncode is None:
         # The program is still running: transmit the current lines
         return CrossDomainResponse({'output_lines': lines,
+                                    'cursor': cursor,
                                     'status': 0,
                                     'completed': False,
                                     'message': "running"})
 
     else:
         return CrossDomainResponse({'output_lines': lines,
+                                    'cursor': cursor,
                                     'status': returncode,
                                     'completed': True,
                                     'message': "completed"})
 
 
+@api_view(['POST'])
+def check_output(request):
+    """Check the output of a running process."""
+    response = not_serving()
+    if response:
+        return response
+
+    retry_after = polls.take(client_of(request))
+    if retry_after:
+        return too_many_requests(retry_after)
+
+    received_json = json.loads(request.body)
+    message = invalid_identifier(received_json) or \
+        invalid_position(received_json)
+    if message:
+        return bad_request(message)
+
+    p = process_handling.ProcessReader(
+        os.path.join(tempfile.gettempdir(), received_json['identifier']))
+    p.touch()
+
+    return output_response(p, received_json)
+
+
+@api_view(['POST'])
+def wait_output(request):
+    """Like check_output, but hold the request until new output is
+       available, the process completes, or the timeout expires.
+    """
+    response = not_serving()
+    if response:
+        return response
+
+    retry_after = polls.take(client_of(request))
+    if retry_after:
+        return too_many_requests(retry_after)
+
+    received_json = json.loads(request.body)
+    message = invalid_identifier(received_json) or \
+        invalid_position(received_json) or invalid_timeout(received_json)
+    if message:
+        return bad_request(message)
+    received_json['cursor'] = received_json.get('cursor') or 0
+    timeout = min(received_json.get('timeout', WAIT_OUTPUT_SECONDS),
+                  WAIT_OUTPUT_SECONDS)
+
+    p = process_handling.ProcessReader(
+        os.path.join(tempfile.gettempdir(), received_json['identifier']))
+
+    # Too many requests are held already: answer as check_output does
+    if not waiting_requests.acquire(False):
+        p.touch()
+        return output_response(p, received_json)
+
+    try:
+        # The client is reading the session all along: say so regularly,
+        # lest it be found abandoned
+        deadline = time.time() + timeout
+        while True:
+            p.touch()
+            remaining = deadline - time.time()
+            if remaining <= 0 or p.wait(received_json['cursor'],
+                                        min(remaining, ABANDON_SECONDS / 2.)):
+                break
+    finally:
+        waiting_requests.release()
+
+    return output_response(p, received_json)
+
+
+@api_view(['POST'])
+def cancel_program(request):
+    """Stop a program whose output is no longer wanted, and remove its
+       session.
+    """
+    response = not_serving()
+    if response:
+        return response
+
+    retry_after = polls.take(client_of(request))
+    if retry_after:
+        return too_many_requests(retry_after)
+
+    received_json = json.loads(request.body)
+    identifier = received_json.get('identifier')
+    if not isinstance(identifier, basestring):
+        return bad_request("the identifier must be a string")
+    if not cancel_session(identifier):
+        return CrossDomainResponse({'identifier': identifier,
+                                    'message': "program not found"})
+
+    return CrossDomainResponse({'identifier': identifier,
+                                'message': "cancelled"})
+
+
+def cancel_session(identifier):
+    """Stop the program read with the given identifier, and remove its
+       session. If the program is shared with other readers, only this
+       reader is removed.
+       Return False if there is no such session.
+    """
+    if not IDENTIFIER_PATTERN.match(identifier):
+        return False
+    working_dir = os.path.join(tempfile.gettempdir(), identifier)
+    shared = os.path.realpath(working_dir)
+
+    # Only touch the dirs of sessions: queued, or with a status file
+    if admission.position(os.path.basename(shared)) is None and \
+            not os.path.isfile(os.path.join(shared, 'status.txt')):
+        return False
+
+    if process_handling.leave_session(working_dir):
+        stop_program(shared)
+    return True
+
+
+def stop_program(working_dir):
+    """Stop the program in the given session dir, queued or running, and
+       remove the dir.
+    """
+    if admission.remove(os.path.basename(working_dir)):
+        process_handling.discard(working_dir)
+    elif process_handling.cancel(working_dir):
+        # The dir is removed once the processes are killed
+        pass
+    elif process_handling.ProcessReader(working_dir).completed():
+        process_handling.discard(working_dir)
+    # Otherwise the program is being launched: if it is still abandoned
+    # then, it is cancelled by cancel_abandoned
+
+
+def cancel_abandoned():
+    """Stop the programs whose output no client has asked for in the last
+       ABANDON_SECONDS.
+    """
+    sessions = process_handling.running_sessions() + [
+        os.path.join(tempfile.gettempdir(), identifier)
+        for identifier in admission.queued_programs()]
+    now = time.time()
+    for working_dir in sessions:
+        last_read = process_handling.ProcessReader(working_dir).last_read()
+        if last_read is not None and now - last_read > ABANDON_SECONDS:
+            print "cancelling abandoned program:", working_dir
+            stop_program(working_dir)
+
+
+def start_canceller():
+    """Start, if this wasn't done already, the task that periodically
+       cancels the abandoned programs.
+    """
+    global canceller_started
+    with canceller_lock:
+        if canceller_started:
+            return
+        canceller_started = True
+
+    def cancel():
+        while True:
+            time.sleep(ABANDON_CHECK_INTERVAL)
+            try:
+                cancel_abandoned()
+            except Exception:
+                print "error when cancelling programs:", sys.exc_info()
+
+    t = Thread(target=cancel)
+    t.daemon = True
+    t.start()
+
+
+@api_view(['GET'])
+def scheduler_status(request):
+    """Return the limit of programs that can be running, the reasons for
+       it, and the programs running and queued. This is only served to
+       this machine, not through the proxy in front of the server.
+    """
+    if request.META.get('REMOTE_ADDR') not in LOCAL_ADDRESSES or \
+            'HTTP_X_FORWARDED_FOR' in request.META:
+        return CrossDomainResponse({'message': "forbidden"}, status=403)
+
+    return CrossDomainResponse(
+        {'adaptive_limit': adaptive_limit.status(),
+         'admission': admission.status(),
+         'backends': dict((b.name, {'in_flight': b.in_flight,
+                                     'up': b.up(time.time())})
+                          for b in backends.dispatcher.backends)})
+
+
 def get_example():
     """Return the example found in the received json, if any"""
 
@@ -118,7 +495,7 @@ def prep_example_directory(example, received_json):
           - the error message if not
     """
     # Create a temporary directory
-    tempd = tempfile.mkdtemp()
+    tempd = process_handling.new_session_dir()
 
     # Copy the original resources in a sandbox directory
     for g in glob.glob(os.path.join(example.original_dir, '*')):
@@ -128,7 +505,7 @@ def prep_example_directory(example, received_json):
     # Overwrite with the user-contributed files
     for file in received_json['files']:
         if len(file['contents']) > RECEIVED_FILE_CHAR_LIMIT:
-            shutil.rmtree(tempd)
+            process_handling.discard(tempd)
             return (None, "file contents exceeds size limits")
         with codecs.open(os.path.join(tempd, file['basename']),
                          'w', 'utf-8') as f:
@@ -139,12 +516,15 @@ def prep_example_directory(example, received_json):
 
 @api_view(['POST'])
 def check_program(request):
+    """Prove the program, as run_program does in mode prove"""
+    response = not_serving()
+    if response:
+        return response
 
-    # Sanity check for the existence of gnatprove
-
-    if not check_gnatprove():
-        return CrossDomainResponse(
-            {'identifier': '', 'message': "gnatprove not found"})
+    client = client_of(request)
+    retry_after = submissions.take(client)
+    if retry_after:
+        return too_many_requests(retry_after)
 
     received_json = json.loads(request.body)
     e = get_example()
@@ -152,39 +532,73 @@ def check_program(request):
         return CrossDomainResponse(
             {'identifier': '', 'message': "example not found"})
 
-    # Check whether we have too many processes running
-    if not resources_available():
-        return CrossDomainResponse(
-            {'identifier': '',
-             'message': "the machine is busy processing too many requests"})
-
     tempd, message = prep_example_directory(e, received_json)
     if message:
         return CrossDomainResponse({'identifier': '', 'message': message})
 
-    doctor_main_gpr(tempd, main, True)
-
-    # Run the command(s) to check the program
-    command = ["gnatprove", "-P", "main", "--checks-as-errors",
-               "--level=0", "--no-axiom-guard"]
-
-    print " ".join(command)
-    try:
-        p = process_handling.SeparateProcess([command], tempd)
-        message = "running gnatprove"
+    return start_program(client, tempd, "prove", None)
 
-    except subprocess.CalledProcessError, exception:
-        message = exception.output
 
-    # Send the result
-    result = {'identifier': os.path.basename(tempd),
-              'message': message}
+def program_size(tempd):
+    """Return the names of the files of the program in tempd, and their
+       total size.
+    """
+    names = [name for name in os.listdir(tempd)
+             if os.path.isfile(os.path.join(tempd, name))]
+    return names, sum(os.path.getsize(os.path.join(tempd, name))
+                      for name in names)
+
+
+def launch_program(tempd, mode, lab, finished=None, fingerprint=None):
+    """Launch the program in tempd on one of the backends.
+       This is called once admission gave a slot to the program: the slot
+       is given back when the program is finished or fails to launch.
+       finished, if given, is then called with whether the program ran to
+       its end.
+       fingerprint, if given, is that of the program, by which it may be
+       dispatched.
+    """
+    start = time.time()
+
+    def on_finish(launched=True, interrupted=False):
+        # The duration of a program which was cancelled, or stopped after
+        # its timeout, is not that of its run: it is not taken into account
+        duration = None
+        if launched and not interrupted:
+            duration = time.time() - start
+            adaptive_limit.observe(duration / nominal_duration(mode, size),
+                                   admission.demand())
+        admission.release(duration, mode)
+        if duration is not None:
+            cost_model.record(mode, names, duration)
+        if finished:
+            finished(launched and not interrupted)
 
-    return CrossDomainResponse(result)
+    try:
+        names, size = program_size(tempd)
+        backends.dispatcher.launch(tempd, mode, lab, on_finish, fingerprint)
+    except Exception:
+        print "error when launching {}:".format(tempd), sys.exc_info()
+        on_finish(False)
+        try:
+            process_handling.record_failure(
+                tempd, "the program could not be launched")
+        except IOError:
+            # The session is gone
+            pass
 
 
 @api_view(['POST'])
 def run_program(request):
+    response = not_serving()
+    if response:
+        return response
+
+    client = client_of(request)
+    retry_after = submissions.take(client)
+    if retry_after:
+        return too_many_requests(retry_after)
+
     received_json = json.loads(request.body)
     e = get_example()
     if not e:
@@ -196,59 +610,129 @@ def run_program(request):
         return CrossDomainResponse({'identifier': '', 'message': message})
 
     print received_json
-    mode = received_json['mode']
+    return start_program(client, tempd, received_json['mode'],
+                         received_json.get('lab'))
+
 
-    # Check whether we have too many processes running
-    if not resources_available():
+def start_program(client, tempd, mode, lab):
+    """Run, or queue, the program in tempd for the given client, and
+       return the response to give it.
+    """
+    identifier = os.path.basename(tempd)
+    result = {'identifier': identifier,
+              'message': "running gnatprove"}
+    fingerprint = coalescing.fingerprint(tempd, mode, lab)
+
+    # An unmodified example gets its precomputed output
+    if USE_PRECOMPUTED_OUTPUTS and serve_precomputed_output(tempd,
+                                                           fingerprint):
+        return CrossDomainResponse(result)
+
+    # Share the run of an identical program in flight if there is one
+    if COALESCE_MODES.get(mode) and coalescer.attach(fingerprint, tempd):
+        return CrossDomainResponse(queue_status(result))
+
+    # The client must not take more than its share of the slots
+    if not fair_share.acquire(client):
+        process_handling.discard(tempd)
+        return too_many_requests(admission.estimated_wait())
+
+    leader_finished = None
+    if COALESCE_MODES.get(mode):
+        leader_finished = coalescer.lead(fingerprint, tempd)
+
+    def finished(ran=False):
+        fair_share.release(client)
+        if leader_finished:
+            leader_finished()
+
+    # Launch the program, or queue it if we have too many processes running
+    process_handling.start_reaper()
+    start_canceller()
+    names, size = program_size(tempd)
+    state = admission.submit(
+        identifier,
+        lambda: launch_program(tempd, mode, lab, finished, fingerprint),
+        mode, cost_model.estimate(mode, names, size), cancelled=finished)
+
+    if state == REJECTED:
+        finished()
+        message = "the machine is busy processing too many requests"
+        # The programs which attached to this one meanwhile get the failure,
+        # and the last of their readers removes the dir
+        process_handling.record_failure(tempd, message)
+        process_handling.remove_session(tempd)
+        retry_after = admission.estimated_wait()
         return CrossDomainResponse(
             {'identifier': '',
-             'message': "the machine is busy processing too many requests"})
+             'message': message,
+             'retry_after': retry_after},
+            headers={'Retry-After': str(retry_after)})
 
-    # Push the code to the container
+    return CrossDomainResponse(queue_status(result))
 
-    try:
-        subprocess.check_call(["lxc", "file", "push", "--recursive", tempd,
-                               "safecontainer/workspace/sessions/"])
-        subprocess.check_call(["lxc", "exec", "safecontainer", "--",
-                               "chown", "-R", "runner",
-                               "/workspace/sessions/{}".format
-                               (os.path.basename(tempd))])
-        subprocess.check_call(["lxc", "exec", "safecontainer", "--",
-                               "chmod", "-R", "a+rx",
-                               "/workspace/sessions/{}".format
-                               (os.path.basename(tempd))])
-    except subprocess.CalledProcessError, exception:
-        result = {'message': "error transferring the program"}
-        return CrossDomainResponse(result)
 
-    # Run the command(s) to check the program
-    run_cmd = "python /workspace/run.py /workspace/sessions/{} {}".format(
-                os.path.basename(tempd), mode)
+def queue_status(result):
+    """Add to the result of run_program the position of the program in the
+       queue, if it is queued.
+    """
+    position = admission.position(coalescing.resolve(result['identifier']))
+    if position is not None:
+        result.update({'message': "queued",
+                       'queue_position': position,
+                       'estimated_wait': admission.estimated_wait(position)})
+    return result
+
+
+def serve_precomputed_output(tempd, fingerprint):
+    """If an output was precomputed for the program in tempd with the given
+       fingerprint, record it in tempd as if the program had run, and
+       return True.
+    """
+    stored = ToolOutput.objects.filter(fingerprint=fingerprint).first()
+    if stored is None:
+        return False
 
-    if 'lab' in received_json:
-        lab = received_json['lab']
-        run_cmd += " {}".format(lab)
+    process_handling.record_output(tempd, stored.output.encode('utf-8'),
+                                   stored.status)
+    ProgramRun(working_dir=tempd).save()
+    return True
 
-    commands = [
-            # Run the program
-            ["lxc", "exec", "safecontainer", "--", "su", "runner",
-             "-c",
-             run_cmd]
-        ]
 
-    print "\n".join(" ".join(c) for c in commands)
+def precompute_output(example, mode):
+    """Run the given example, with its files unmodified, in the given mode,
+       and store its output for run_program to serve to the identical
+       programs.
+       Return the stored ToolOutput, None if the example could not be run.
+    """
+    files = [{'basename': r.basename, 'contents': r.contents}
+             for r in example.resources.all()]
+    tempd, message = prep_example_directory(get_example(), {'files': files})
+    if message:
+        print message
+        return None
+    fingerprint = coalescing.fingerprint(tempd, mode, None)
 
-    try:
-        p = process_handling.SeparateProcess(commands, tempd)
-        stored_run = ProgramRun(working_dir=p.working_dir)
-        stored_run.save()
-        message = "running gnatprove"
+    ran = []
+    done = Event()
+
+    def finished(ran_to_end):
+        ran.append(ran_to_end)
+        done.set()
 
-    except subprocess.CalledProcessError, exception:
-        message = exception.output
+    # This runs in its own process, with all the slots free
+    admission.acquire(mode)
+    launch_program(tempd, mode, None, finished, fingerprint)
 
-    # Send the result
-    result = {'identifier': os.path.basename(tempd),
-              'message': message}
+    p = process_handling.ProcessReader(tempd)
+    output = list(p.follow(WAIT_OUTPUT_SECONDS))
+    status = p.poll()
+    if not done.wait(WAIT_OUTPUT_SECONDS) or not ran[0]:
+        # The program could not be launched, or was interrupted: this is
+        # not its output
+        return None
 
-    return CrossDomainResponse(result)
+    example.outputs.filter(mode=mode).delete()
+    return ToolOutput.objects.create(
+        example=example, mode=mode, fingerprint=fingerprint, status=status,
+        output="".join(output).decode('utf-8', 'replace'))
@@ -0,0 +1,95 @@
+# This package lets identical programs share one run.
+#
+# When a program is submitted while an identical one (same files, mode and
+# lab) is in flight, the new submission does not launch anything: its
+# session dir is replaced with a symbolic link to the dir of the program in
+# flight, so that its reader gets the same output.
+#
+# The readers of a shared dir each have a file in its READERS_DIR, and the
+# dir is removed by the last of them to see the program completed; see
+# process_handling.remove_session.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+from compile_server.app.process_handling import READERS_DIR
+
+
+def fingerprint(working_dir, mode, lab):
+    """Return the fingerprint of the program with the files in working_dir
+       run in the given mode and lab.
+    """
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(working_dir)):
+        path = os.path.join(working_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        h.update("{}\0{}\0".format(name, len(data)))
+        h.update(data)
+    h.update(json.dumps([mode, lab]))
+    return h.hexdigest()
+
+
+def resolve(identifier):
+    """Return the identifier of the program whose output is read with the
+       given identifier: itself, unless it shares the run of another.
+    """
+    return os.path.basename(os.path.realpath(
+        os.path.join(tempfile.gettempdir(), identifier)))
+
+
+class Coalescer(object):
+
+    def __init__(self):
+        self.in_flight = {}  # the working dir of the program with each
+                             # fingerprint
+        self.lock = Lock()
+
+    def lead(self, fingerprint, working_dir):
+        """Record that the program in working_dir is in flight, so that
+           identical programs can share its run.
+           Return the function to call once it is finished.
+        """
+        readers = os.path.join(working_dir, READERS_DIR)
+        os.mkdir(readers)
+        open(os.path.join(readers, os.path.basename(working_dir)),
+             'wb').close()
+
+        with self.lock:
+            self.in_flight[fingerprint] = working_dir
+
+        def finished():
+            with self.lock:
+                if self.in_flight.get(fingerprint) == working_dir:
+                    del self.in_flight[fingerprint]
+
+        return finished
+
+    def attach(self, fingerprint, working_dir):
+        """If a program with the given fingerprint is in flight, replace
+           working_dir with a link to its dir, and return True. Otherwise
+           return False, leaving working_dir as it is.
+        """
+        with self.lock:
+            leader = self.in_flight.get(fingerprint)
+        if leader is None:
+            return False
+
+        # Register as a reader first: this fails if the last reader of the
+        # dir has just removed it
+        marker = os.path.join(leader, READERS_DIR,
+                              os.path.basename(working_dir))
+        try:
+            open(marker, 'wb').close()
+        except IOError:
+            return False
+
+        shutil.rmtree(working_dir)
+        os.symlink(leader, working_dir)
+        return True
@@ -0,0 +1,159 @@
+# This package adapts the number of programs that can be running at the
+# same time to the capacity of the machine, which depends on the programs:
+# many runs of small programs, but fewer proofs.
+#
+# AdaptiveLimit follows AIMD (additive increase, multiplicative decrease),
+# once per window of ADJUST_INTERVAL seconds:
+#   - the limit is cut by DECREASE_FACTOR when the machine is overloaded,
+#     that is when the programs take much longer than they do on an idle
+#     machine, or the CPU or the memory of the host are nearly exhausted
+#   - otherwise, it is raised by INCREASE_STEP if the programs asked for
+#     all the slots during the window: the limit only grows when it is
+#     what holds the programs back.
+#
+# The durations of the programs are compared to their nominal durations
+# (see admission.nominal_duration), which differ between modes and sizes of
+# files. The ratio of the two on an idle machine, the baseline, is learnt:
+# it is the lowest median ratio of the windows, which drifts up slowly
+# while the machine is not overloaded, so that it follows a slower machine.
+
+import time
+import psutil
+from collections import deque
+from threading import Lock
+
+ADJUST_INTERVAL = 5
+# Number of seconds between two adjustments of the limit
+
+MIN_SAMPLES = 5
+# The number of programs which must have finished in a window for their
+# durations to be taken into account
+
+LATENCY_TOLERANCE = 2.0
+# The factor by which the median duration of the programs may exceed the
+# baseline before the machine is considered overloaded
+
+BASELINE_DRIFT = 0.01
+# The fraction by which the baseline rises at each window
+
+CPU_TARGET = 90
+MEMORY_TARGET = 90
+# The percentages of use of the CPU and of the memory of the host above
+# which the machine is considered overloaded
+
+DECREASE_FACTOR = 0.75
+# The factor by which the limit is cut when the machine is overloaded
+
+INCREASE_STEP = 4
+# The number of slots added when all the slots were used
+
+USE_THRESHOLD = 0.9
+# The fraction of the slots which must have been asked for during a window
+# for the limit to be raised
+
+HISTORY_LENGTH = 20
+# The number of past adjustments kept for display
+
+
+class AdaptiveLimit(object):
+
+    def __init__(self, initial, minimum, maximum, apply, host_load=True):
+        """initial, minimum and maximum are the limits on the number of
+           programs running at the same time.
+           apply is called with the new limit each time it changes.
+           host_load is whether to take into account the load of this
+           machine, that is whether the programs run on it.
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.apply = apply
+        self.host_load = host_load
+        self.baseline = None     # the ratio to the nominal duration on an
+                                 # idle machine, see above
+        self.ratios = []         # those of the programs of this window
+        self.demand = 0          # the most slots asked for in this window
+        self.window_start = time.time()
+        self.reason = "initial limit"
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self.lock = Lock()
+
+        if host_load:
+            # The first call only starts the measure
+            psutil.cpu_percent(None)
+
+    def observe(self, ratio, demand):
+        """Record a finished program.
+           ratio is its duration divided by its nominal duration, and demand
+           the number of programs which were running or queued.
+        """
+        with self.lock:
+            self.ratios.append(ratio)
+            self.demand = max(self.demand, demand)
+            if time.time() - self.window_start < ADJUST_INTERVAL:
+                return
+            limit = self._adjust()
+
+        if limit is not None:
+            self.apply(limit)
+
+    def _adjust(self):
+        """End the window, and compute the new limit from it.
+           Return it if it changed, otherwise None.
+        """
+        overloaded = []
+
+        if len(self.ratios) >= MIN_SAMPLES:
+            median = sorted(self.ratios)[len(self.ratios) // 2]
+            if self.baseline is None:
+                self.baseline = median
+            elif median > LATENCY_TOLERANCE * self.baseline:
+                overloaded.append(
+                    "the programs took {:.1f} times longer than on an idle "
+                    "machine".format(median / self.baseline))
+            else:
+                self.baseline = min(self.baseline * (1 + BASELINE_DRIFT),
+                                    median)
+
+        if self.host_load:
+            cpu = psutil.cpu_percent(None)
+            memory = psutil.virtual_memory().percent
+            if cpu > CPU_TARGET:
+                overloaded.append("the CPU was {:.0f}% used".format(cpu))
+            if memory > MEMORY_TARGET:
+                overloaded.append(
+                    "the memory was {:.0f}% used".format(memory))
+
+        limit = self.limit
+        if overloaded:
+            limit = max(self.minimum, int(limit * DECREASE_FACTOR))
+            self.reason = "decreased: " + ", ".join(overloaded)
+        elif self.demand >= USE_THRESHOLD * limit:
+            limit = min(self.maximum, limit + INCREASE_STEP)
+            self.reason = "increased: {} programs asked for a slot".format(
+                self.demand)
+        else:
+            self.reason = "unchanged: {} programs asked for a slot".format(
+                self.demand)
+
+        self.ratios = []
+        self.demand = 0
+        self.window_start = time.time()
+        if limit == self.limit:
+            return None
+
+        self.history.append({'time': int(self.window_start),
+                             'limit': limit,
+                             'reason': self.reason})
+        self.limit = limit
+        return limit
+
+    def status(self):
+        """Return the current limit and the reasons for it, for display"""
+        with self.lock:
+            return {'limit': self.limit,
+                    'minimum': self.minimum,
+                    'maximum': self.maximum,
+                    'reason': self.reason,
+                    'baseline': self.baseline,
+                    'history': list(self.history)}
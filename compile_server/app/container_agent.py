@@ -0,0 +1,261 @@
+# This package runs programs through the agent which runs in the container
+# (see infrastructure/container_payload/agent.py) instead of launching
+# "lxc exec ... python run.py" for each of them.
+#
+# The connections to the agent of each container are kept in a pool: a
+# connection is taken for a job, and given back once the agent has sent the
+# status of the job.
+#
+# The job is sent by the caller of AgentJob, so that connecting, which may
+# take time with a worker on another machine, does not hold up the
+# Supervisor, which only reads the output.
+
+import json
+import select
+import socket
+import time
+from threading import Lock
+
+from compile_server.app.process_handling import SeparateProcess
+
+MAX_IDLE_CONNECTIONS = 32
+# The number of idle connections kept in the pool
+
+CONNECT_TIMEOUT = 2
+# Number of seconds after which a connection to an agent is given up
+
+PROBE_TIMEOUT = 0.1
+# Number of seconds for which a new connection to an agent is watched when
+# probing it: the agent sends nothing before it gets a job, so a connection
+# closed meanwhile is one which nothing serves (e.g. the proxy of lxd)
+
+PROBE_INTERVAL = 10
+# Number of seconds for which the result of a probe is kept
+
+STATUS_PREFIX = '{"status": '
+# The start of the last record sent by the agent for a job
+
+STARTED_RECORD = '{"started": true}'
+# The record sent by a worker when the job leaves its queue to run: the
+# time the job takes is counted from there, see Supervisor._timeout
+
+CONNECTION_LOST_STRING = "the connection to the agent was lost"
+# The message written when the agent goes away before the end of a job
+
+
+pools_lock = Lock()
+pools = {}
+# The ConnectionPool of each agent socket
+
+probes_lock = Lock()
+probes = {}
+# The time and the result of the last probe of each agent, see available()
+
+
+def available(address):
+    """Return whether the agent with the given address can be reached. The
+       answer is kept for PROBE_INTERVAL seconds.
+    """
+    now = time.time()
+    with probes_lock:
+        if address in probes and now - probes[address][0] < PROBE_INTERVAL:
+            return probes[address][1]
+
+    result = probe(address)
+    with probes_lock:
+        probes[address] = (now, result)
+    return result
+
+
+def set_unavailable(address):
+    """Record that the agent with the given address cannot be reached"""
+    with probes_lock:
+        probes[address] = (time.time(), False)
+
+
+def probe(address):
+    """Return whether a connection can be made to the agent with the given
+       address, and is kept open by it.
+    """
+    pool = get_pool(address)
+    try:
+        s = pool.connect()
+    except socket.error:
+        return False
+
+    readable, _, _ = select.select([s], [], [], PROBE_TIMEOUT)
+    if readable:
+        s.close()
+        return False
+
+    # The connection can serve the next job
+    pool.put(s)
+    return True
+
+
+def get_pool(address):
+    """Return the pool of connections to the agent with the given address,
+       see ConnectionPool.
+    """
+    with pools_lock:
+        if address not in pools:
+            pools[address] = ConnectionPool(address)
+        return pools[address]
+
+
+class ConnectionPool(object):
+
+    def __init__(self, address):
+        """address is the path of the unix socket of the agent, or the
+           (host, port) pair of a worker speaking the same protocol.
+        """
+        self.address = address
+        self.idle = []
+        self.lock = Lock()
+
+    def connect(self):
+        """Return a new connection to the agent"""
+        if isinstance(self.address, tuple):
+            s = socket.create_connection(self.address, CONNECT_TIMEOUT)
+        else:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(CONNECT_TIMEOUT)
+            try:
+                s.connect(self.address)
+            except socket.error:
+                s.close()
+                raise
+        # The output is read from the fd, which must block
+        s.settimeout(None)
+        return s
+
+    def get(self):
+        """Return a connection to the agent, reusing an idle one if
+           possible, and whether it was reused.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                s = self.idle.pop()
+
+            # An idle connection should have nothing to read: if it has, it
+            # was closed by the agent
+            readable, _, _ = select.select([s], [], [], 0)
+            if not readable:
+                return s, True
+            s.close()
+
+        return self.connect(), False
+
+    def put(self, s):
+        """Give back a connection taken with get(), once the job is done"""
+        with self.lock:
+            if len(self.idle) < MAX_IDLE_CONNECTIONS:
+                self.idle.append(s)
+                return
+        s.close()
+
+
+class AgentJob(SeparateProcess):
+    """Like SeparateProcess, but running one job through the agent"""
+
+    def __init__(self, job, cwd, address, on_finish=None):
+        """job is the description of the job to send to the agent, see
+           agent.py, and address that of the agent, see ConnectionPool.
+           The other arguments are those of SeparateProcess.
+        """
+        self.job = job
+        self.pool = get_pool(address)
+        self.received = False     # whether the agent has sent anything
+        self.agent_status = None  # the status sent by the agent
+
+        # Send the job, raising socket.error if the agent cannot be reached
+        self.sock, self.reused = self.pool.get()
+        try:
+            self.sock.sendall(self.request())
+        except socket.error:
+            self.sock.close()
+            if not self.reused:
+                raise
+            # The agent has closed the connection since it was used
+            self.sock, self.reused = self.pool.connect(), False
+            self.sock.sendall(self.request())
+
+        try:
+            super(AgentJob, self).__init__([job], cwd, on_finish)
+        except Exception:
+            # Closing the connection makes the agent kill the job
+            self.sock.close()
+            raise
+
+    def start_next(self):
+        # The job was sent already
+        self.run_count += 1
+        self.fd = self.sock.fileno()
+        return self.fd
+
+    def request(self):
+        return json.dumps(self.job) + "\n"
+
+    def resume(self):
+        if self.agent_status is not None:
+            return None
+
+        # The agent may close an idle connection just as we reuse it: in
+        # this case nothing was received, and the job is sent again on a
+        # new connection. This is done by the Supervisor, so only for the
+        # agents of the containers of this machine, whose socket is local.
+        local = not isinstance(self.pool.address, tuple)
+        if self.reused and not self.received and local:
+            self.reused = False
+            self.sock = self.pool.connect()
+            self.sock.sendall(self.request())
+            self.fd = self.sock.fileno()
+            return self.fd
+
+        # The connection was lost before the end of the job, which counts
+        # as interrupted
+        self.interrupted = True
+        if not self.received and local:
+            # Nothing serves the socket: the next programs are run without
+            # the agent
+            set_unavailable(self.pool.address)
+        if self.partial or self.dropped:
+            self.write("\n")
+        self._write_record(json.dumps(
+            {"internal_error": {"msg": CONNECTION_LOST_STRING}}))
+        self.output.flush()
+        return None
+
+    def write(self, data):
+        self.received = True
+        super(AgentJob, self).write(data)
+
+    def _write_line(self, line):
+        if line.startswith(STATUS_PREFIX):
+            self.agent_status = json.loads(line)["status"]
+        elif line.rstrip('\n') == STARTED_RECORD:
+            self.time = time.time()
+        else:
+            super(AgentJob, self)._write_line(line)
+
+    def stream_done(self):
+        return self.agent_status is not None
+
+    def close_stream(self):
+        if self.agent_status is not None and not self.interrupted:
+            self.pool.put(self.sock)
+        else:
+            # Closing the connection makes the agent kill the job
+            self.sock.close()
+
+    def exit_status(self):
+        if self.agent_status is None:
+            # The connection was lost before the end of the job
+            return 1
+        return self.agent_status
+
+    def kill(self):
+        # The connection was closed with close_stream: this is enough
+        pass
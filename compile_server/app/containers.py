@@ -0,0 +1,175 @@
+# This package chooses the container in which to run each program.
+#
+# The programs are run in a pool of identical containers (see the variable
+# SAFECONTAINERS of infrastructure/Makefile). Each program goes to the
+# healthy container which has the fewest programs in flight.
+#
+# The containers are checked periodically: one which does not answer is
+# left out until it does again. One which becomes much slower than the
+# others is drained, that is given no new programs, and restarted once its
+# programs are finished. The speed of the containers is compared on the
+# durations of their programs divided by their nominal durations (see
+# admission.nominal_duration), so that a container is not found slow for
+# having run more proofs than the others.
+
+import os
+import subprocess
+import sys
+import time
+from threading import Thread, Lock
+
+CONTAINERS = os.environ.get("SAFECONTAINERS", "safecontainer").split()
+# The names of the containers of the pool
+
+AGENT_POOL_SIZE = 64
+# The number of jobs that the agent of a container runs at the same time,
+# see POOL_SIZE in infrastructure/container_payload/agent.py
+
+HEALTH_CHECK_INTERVAL = 15
+# Number of seconds between two checks of the containers
+
+HEALTH_CHECK_TIMEOUT = 10
+# Number of seconds after which a container which does not answer a check
+# is considered unhealthy
+
+DURATION_WEIGHT = 0.1
+# The weight of the last program in the average ratio of a container
+
+MIN_PROGRAMS = 20
+# The number of programs a container must have run before it can be found
+# slow
+
+SLOW_FACTOR = 3.0
+# The factor by which the average ratio of a container must exceed that of
+# the pool for the container to be recycled
+
+
+def agent_socket(name):
+    """Return the host end of the socket of the agent in the container"""
+    return "/tmp/{}-agent.sock".format(name)
+
+
+class Container(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.agent_socket = agent_socket(name)
+        self.in_flight = 0          # the number of programs running in it
+        self.programs = 0           # the number of programs it has run
+        self.average_ratio = 0.0    # that of the durations of its programs
+                                    # to their nominal durations
+        self.healthy = True
+        self.draining = False       # whether it is to be recycled
+
+
+class ContainerPool(object):
+
+    def __init__(self, names):
+        self.containers = [Container(name) for name in names]
+        self.lock = Lock()
+        self.checks_started = False
+
+    def acquire(self):
+        """Return the container in which to run a new program, counting
+           the program in its load: it must be given back with release().
+        """
+        self.start_health_checks()
+        with self.lock:
+            candidates = [c for c in self.containers
+                          if c.healthy and not c.draining]
+
+            # If no container is fit, still try the least loaded one rather
+            # than failing the program
+            container = min(candidates or self.containers,
+                            key=lambda c: c.in_flight)
+            container.in_flight += 1
+            return container
+
+    def release(self, container, ratio=None):
+        """Give back a container obtained with acquire(), once the program
+           is finished. ratio is the duration of the program divided by its
+           nominal duration, if known.
+        """
+        with self.lock:
+            container.in_flight -= 1
+            if ratio is not None:
+                container.programs += 1
+                container.average_ratio += (
+                    DURATION_WEIGHT * (ratio - container.average_ratio))
+                if not container.draining and self._slow(container):
+                    print "draining slow container", container.name
+                    container.draining = True
+
+            recycle = container.draining and container.in_flight == 0
+
+        if recycle:
+            self._recycle(container)
+
+    def _slow(self, container):
+        """Return whether the container is much slower than the others"""
+        others = [c for c in self.containers
+                  if c is not container and c.healthy and not c.draining and
+                  c.programs >= MIN_PROGRAMS]
+        if not others or container.programs < MIN_PROGRAMS:
+            return False
+        average = sum(c.average_ratio for c in others) / len(others)
+        return container.average_ratio > SLOW_FACTOR * average
+
+    def _recycle(self, container):
+        """Restart the given drained container, in the background"""
+        def restart():
+            print "restarting container", container.name
+            subprocess.call(["lxc", "restart", "--force", container.name])
+            with self.lock:
+                container.programs = 0
+                container.average_ratio = 0.0
+                container.draining = False
+                container.healthy = False  # until the next check
+
+        t = Thread(target=restart)
+        t.daemon = True
+        t.start()
+
+    def check(self, container):
+        """Return whether the container answers"""
+        try:
+            return subprocess.call(
+                ["timeout", str(HEALTH_CHECK_TIMEOUT),
+                 "lxc", "exec", container.name, "--", "true"]) == 0
+        except OSError:
+            return False
+
+    def check_all(self):
+        """Check all the containers, updating their health"""
+        for container in self.containers:
+            healthy = self.check(container)
+            with self.lock:
+                changed = healthy != container.healthy
+                container.healthy = healthy
+            if changed:
+                print "container {} is {}".format(
+                    container.name, "healthy" if healthy else "unhealthy")
+
+    def start_health_checks(self):
+        """Start, if this wasn't done already, the task that periodically
+           checks the containers.
+        """
+        with self.lock:
+            if self.checks_started:
+                return
+            self.checks_started = True
+
+        def run_checks():
+            while True:
+                time.sleep(HEALTH_CHECK_INTERVAL)
+                try:
+                    self.check_all()
+                except Exception:
+                    print "error when checking containers:", sys.exc_info()
+
+        t = Thread(target=run_checks)
+        t.daemon = True
+        t.start()
+
+
+pool = ContainerPool(CONTAINERS)
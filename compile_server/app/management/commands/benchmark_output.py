@@ -0,0 +1,74 @@
+# The manage.py command to measure the cost of polling the output of a
+# program as this output grows.
+# This is meant to be used by the developers of the project only.
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from compile_server.app.process_handling import ProcessReader
+
+LINE = "this is a line of output from a chatty program: 0123456789\n"
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megabytes', nargs=1, type=int, default=[8],
+                            help='the size of the output to reach')
+
+        parser.add_argument('--polls', nargs=1, type=int, default=[20],
+                            help='the number of polls at each output size')
+
+    def handle(self, *args, **options):
+        target = options['megabytes'][0] * 1024 * 1024
+        polls = options['polls'][0]
+
+        tempd = tempfile.mkdtemp()
+        reader = ProcessReader(tempd)
+        chunk = LINE * 1000
+
+        try:
+            print "{:>10} {:>16} {:>16}".format(
+                "size (KB)", "cursor (ms)", "already_read (ms)")
+
+            size = 0
+            cursor = 0
+            lines_read = 0
+            next_report = len(chunk)
+            while size < target:
+                with open(reader.output_file, 'ab') as f:
+                    f.write(chunk)
+                size += len(chunk)
+
+                if size < next_report:
+                    continue
+                next_report *= 2
+
+                # Each poll returns the one line written since the last poll
+                start = time.time()
+                for _ in range(polls):
+                    with open(reader.output_file, 'ab') as f:
+                        f.write(LINE)
+                    size += len(LINE)
+                    lines, cursor = reader.read_from(cursor)
+                cursor_cost = (time.time() - start) / polls
+
+                lines_read = len(reader.read_lines(0))
+                start = time.time()
+                for _ in range(polls):
+                    with open(reader.output_file, 'ab') as f:
+                        f.write(LINE)
+                    size += len(LINE)
+                    lines = reader.read_lines(lines_read)
+                    lines_read += len(lines)
+                legacy_cost = (time.time() - start) / polls
+
+                # Catch up the cursor with the lines written above
+                lines, cursor = reader.read_from(cursor)
+
+                print "{:>10} {:>16.3f} {:>16.3f}".format(
+                    size / 1024, cursor_cost * 1000, legacy_cost * 1000)
+        finally:
+            shutil.rmtree(tempd)
@@ -8,10 +8,15 @@ import yaml
 from django.core.management.base import BaseCommand
 
 from compile_server.app.models import Resource, Example
+from compile_server.app import checker
 
 included_extensions = ['.ads', '.adb']
 # The extensions for the files that we want to show in the examples
 
+default_modes = ['run']
+# The modes in which to precompute the output of an example, unless its
+# example.yaml lists them in a field "modes"
+
 
 class Command(BaseCommand):
 
@@ -26,6 +31,12 @@ class Command(BaseCommand):
         parser.add_argument('--conf', nargs=1, type=str,
                             help='parse yaml file and clone repos and add examples')
 
+        parser.add_argument('--precompute', const=True, default=False,
+                            action='store_const',
+                            help='run the examples in the database and store'
+                                 ' their output, to serve it to unmodified'
+                                 ' examples')
+
     def handle(self, *args, **options):
         
         def add_directory(d):
@@ -104,4 +115,21 @@ class Command(BaseCommand):
                         return
                     for example in source["examples"]:
                         add_directory(os.path.abspath(os.path.join(dest_dir, example)))
-                    
+
+        if options.get('precompute', False):
+            for e in Example.objects.all():
+                if not e.resources.exists():
+                    continue
+
+                modes = default_modes
+                example_yaml = os.path.join(e.original_dir, 'example.yaml')
+                if os.path.isfile(example_yaml):
+                    with open(example_yaml, 'rb') as f:
+                        modes = (yaml.safe_load(f) or {}).get('modes', modes)
+
+                for mode in modes:
+                    print "running {} in mode {}".format(e.name, mode)
+                    stored = checker.precompute_output(e, mode)
+                    if stored is None:
+                        print "could not precompute the output of {}".format(
+                            e.name)
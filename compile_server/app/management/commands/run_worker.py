@@ -0,0 +1,174 @@
+# The manage.py command to run the programs sent by other servers.
+#
+# The servers which have this worker in their EXECUTION_WORKERS send it
+# jobs over TCP, in the protocol of the agent of the containers (see
+# infrastructure/container_payload/agent.py): the worker runs them in its
+# own containers, and sends back their output followed by their status.
+# As with the agent, a job is killed if the server closes the connection
+# before it is finished.
+#
+# The worker sends a record when a job leaves its queue to run, so that
+# the server counts the time of the job from there.
+#
+# The worker must be run without EXECUTION_WORKERS, and its port must only
+# be reachable by the servers: it listens on the loopback interface unless
+# told otherwise, for instance on a private interface. Each job must carry
+# the secret of the worker, EXECUTION_SECRET, which must be set to listen
+# on another interface. Several workers can be run on one machine, on
+# different ports, to try a setup with several hosts.
+import codecs
+import hmac
+import json
+import os
+import select
+import socket
+import SocketServer
+from threading import Thread, Event, Lock
+
+from django.core.management.base import BaseCommand, CommandError
+
+from compile_server.app import checker, process_handling
+from compile_server.app.admission import REJECTED
+from compile_server.app.backends import SECRET
+from compile_server.app.container_agent import STARTED_RECORD
+
+WORKER_PORT = 8200
+# The default port on which the worker listens
+
+WORKER_HOST = "127.0.0.1"
+# The default address on which the worker listens
+
+WATCH_INTERVAL = 1
+# Number of seconds between two looks at whether the server has closed the
+# connection of a running job
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """Run the jobs received on one connection, one after the other"""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.send_lock = Lock()
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                job = json.loads(line)
+                secret = job.get('secret')
+                if not isinstance(secret, basestring) or \
+                        not hmac.compare_digest(secret.encode('utf-8'),
+                                                SECRET):
+                    # Do not serve whoever this is
+                    self.send("wrong secret\n")
+                    self.send_status(1)
+                    return
+                tempd = self.prepare(job)
+            except (ValueError, KeyError, IOError), exception:
+                self.send("{}\n".format(exception))
+                self.send_status(1)
+                continue
+
+            try:
+                status = self.run(tempd, job)
+            except socket.error:
+                # The server has gone: the program was cancelled by watch
+                return
+            self.send_status(status)
+
+    def prepare(self, job):
+        """Write the files of job in a new session dir, return its name"""
+        tempd = process_handling.new_session_dir()
+        for file in job['files']:
+            with codecs.open(os.path.join(tempd,
+                                          os.path.basename(file['basename'])),
+                             'w', 'utf-8') as f:
+                f.write(file['contents'])
+        return tempd
+
+    def run(self, tempd, job):
+        """Run the program in tempd, sending its output as it comes.
+           Return its status.
+        """
+        mode = job['mode']
+        lab = job.get('lab')
+
+        def launch():
+            try:
+                self.send(STARTED_RECORD + "\n")
+            except socket.error:
+                # The server has gone: the program is cancelled by watch
+                pass
+            checker.launch_program(tempd, mode, lab)
+
+        state = checker.admission.submit(os.path.basename(tempd), launch,
+                                         mode)
+        if state == REJECTED:
+            process_handling.record_failure(
+                tempd, "the machine is busy processing too many requests")
+
+        done = Event()
+        watcher = Thread(target=self.watch, args=(tempd, done))
+        watcher.daemon = True
+        watcher.start()
+        try:
+            p = process_handling.ProcessReader(tempd)
+            for line in p.follow(checker.WAIT_OUTPUT_SECONDS):
+                self.send(line)
+            return p.poll()
+        finally:
+            done.set()
+
+    def watch(self, tempd, done):
+        """Cancel the program in tempd if the server closes the connection
+           before done is set.
+        """
+        while not done.is_set():
+            readable, _, _ = select.select([self.connection], [], [],
+                                           WATCH_INTERVAL)
+            if not readable or done.is_set():
+                continue
+            # The server sends nothing while the job runs: this is the end
+            # of the connection
+            try:
+                closed = not self.connection.recv(1, socket.MSG_PEEK)
+            except socket.error:
+                closed = True
+            if closed:
+                checker.stop_program(tempd)
+            return
+
+    def send(self, data):
+        # The record of the start of the job is sent from another thread
+        with self.send_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def send_status(self, status):
+        self.send(json.dumps({"status": status}) + "\n")
+
+
+class WorkerServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', nargs=1, type=int, default=[WORKER_PORT],
+                            help='the port on which to listen')
+
+        parser.add_argument('--host', nargs=1, type=str,
+                            default=[WORKER_HOST],
+                            help='the address on which to listen, which '
+                                 'must only be reachable by the servers')
+
+    def handle(self, *args, **options):
+        address = (options['host'][0], options['port'][0])
+        if not SECRET and address[0] != WORKER_HOST:
+            raise CommandError(
+                "EXECUTION_SECRET must be set to listen on {}".format(
+                    address[0]))
+        server = WorkerServer(address, JobHandler)
+        print "worker listening on {}:{}".format(*address)
+        server.serve_forever()
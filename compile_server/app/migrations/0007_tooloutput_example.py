@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_programrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tooloutput',
+            name='example',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='outputs', to='app.Example'),
+        ),
+        migrations.AddField(
+            model_name='tooloutput',
+            name='fingerprint',
+            field=models.CharField(db_index=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='tooloutput',
+            name='mode',
+            field=models.TextField(default=''),
+        ),
+    ]
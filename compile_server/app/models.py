@@ -15,6 +15,17 @@ class ToolOutput(models.Model):
     # The complete raw output
     output = models.TextField()
 
+    # The example on which the tool was run, if the output was precomputed
+    example = models.ForeignKey('Example', null=True,
+                                on_delete=models.CASCADE,
+                                related_name='outputs')
+
+    # The mode in which the program was run
+    mode = models.TextField(default='')
+
+    # The fingerprint of the program run, see coalescing.fingerprint
+    fingerprint = models.CharField(max_length=40, default='', db_index=True)
+
 
 class Resource(models.Model):
     """This represents a file or a directory.
@@ -1,22 +1,45 @@
 # This package contains two classes that can be used to launch processes
 # and process their output.
 #
-# SeparateProcess is used to launch a series of processes: for each instance,
-# a task is created to monitor the output of the processes.
+# SeparateProcess is used to launch a series of processes: the processes of
+# all the instances are run and monitored by one Supervisor task.
 #
 # ProcessReader is used to read the current status of a process.
 #
 # The code expects that the client will make regular calls to
 # ProcessReader.poll() until the processes are completed.
-
+#
+# The processes of a session can be stopped early with cancel(), when its
+# client is gone.
+#
+# The session dirs are not deleted on the path of a request: a completed
+# session is left readable for TEARDOWN_GRACE seconds, then moved to
+# TRASH_DIR, which is emptied by a task of its own. The sessions due to be
+# removed are only known to this server process: those it did not remove,
+# for instance because it was restarted, are removed by the reaper once
+# they have been completed for MAX_SESSION_AGE seconds. The temporary dir
+# is shared with other users: only the dirs of ours whose name starts with
+# SESSION_PREFIX are taken for sessions, and the trash is only used if it
+# is a dir of ours which others cannot write to.
+
+import errno
+import functools
+import heapq
+import json
 import os
+import select
 import shutil
+import signal
+import socket
+import stat
 import sys
 import subprocess
+import tempfile
 import time
 import psutil
-from threading import Thread
-from Queue import Queue, Empty
+from collections import deque
+from threading import Thread, Lock
+from Queue import Queue
 from compile_server.app.models import ProgramRun
 from safe_run import INTERRUPT_STRING
 
@@ -27,96 +50,506 @@ TIMEOUT_SECONDS = 30
 MAX_SESSION_AGE = 60
 # Number of seconds after which to remove a session from memory
 
+REAPER_INTERVAL = 30
+# Number of seconds between two cleanups of the old processes
+
+WAIT_POLL_INTERVALS = [0.02, 0.05, 0.1, 0.25]
+# The successive intervals, in seconds, at which ProcessReader.wait looks
+# at the session files; the last one is repeated
+
+READ_SIZE = 65536
+# The maximum number of bytes read at once from the output of a process
+
+REAP_INTERVAL = 0.05
+# Number of seconds between two checks for the exit of a process which has
+# closed its output
+
+OUTPUT_MAX_LINES = 10000
+# The number of lines of output of a session that are kept in full
+
+OUTPUT_MAX_BYTES = 2 * 1024 * 1024
+# The number of bytes of output of a session that are kept in full
+
+OUTPUT_TAIL_LINES = 200
+# The number of the last lines of output kept once the above are exceeded
+
+OUTPUT_RECORD_LENGTH = 256 * 1024
+# The length beyond which a record of output, that is a line, is dropped.
+# The records are JSON objects, which are never split: the lines printed by
+# the programs are bounded by run.py, inside the container.
+
+ELIDED_STRING = "<{} lines elided>"
+# The marker left in place of the lines of output which were not kept
+
+OVERSIZED_STRING = "<a record of {} bytes elided>"
+# The message left in place of a record of output which was too long
+
+READERS_DIR = "readers"
+# The dir, in a session dir read by several clients, which has one file per
+# client still reading it
+
+SESSION_PREFIX = "session_"
+# The prefix of the names of the session dirs, see new_session_dir
+
+TRASH_DIR = os.path.join(tempfile.gettempdir(), "compile_server_trash")
+# The dir to which the session dirs are moved, to be deleted later; it must
+# be on the same filesystem as them
+
+TEARDOWN_GRACE = 10
+# Number of seconds during which a completed session can still be read
+
+TEARDOWN_INTERVAL = 1
+# Number of seconds between two deletions of the sessions in the trash
+
+reaper_lock = Lock()
+reaper_started = False
+
+supervisor_lock = Lock()
+supervisor = None
+
+teardown_lock = Lock()
+teardown_started = False
+teardown_queue = {}  # the time at which to remove each session dir
+trash_count = 0
+trash_usable = None  # whether TRASH_DIR can be used, once checked
+
+
+class Supervisor(object):
+    """A task which runs the processes of all the SeparateProcess instances
+       of this server process: it multiplexes their output with a poller,
+       and enforces the timeouts from a heap of deadlines.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = []      # SeparateProcess instances to start
+        self.by_fd = {}        # the SeparateProcess reading each fd
+        self.timers = []       # heap of (time, sequence, action, sp, run)
+        self.running = {}      # the SeparateProcess of each session dir
+        self.cancelled = []    # SeparateProcess instances to cancel
+        self.sequence = 0
+        self.poller = select.poll()
+        self.callbacks = Queue()
+
+        # The pipe on which to wake up the task when there is a new instance
+        self.wake_r, self.wake_w = os.pipe()
+        self.poller.register(self.wake_r, select.POLLIN)
+
+        t = Thread(target=self._loop)
+        t.daemon = True
+        t.start()
+
+        # The callbacks may take time, for instance to launch the next
+        # queued program: they are run from a task of their own
+        t2 = Thread(target=self._run_callbacks)
+        t2.daemon = True
+        t2.start()
+
+    def add(self, sp):
+        """Start running the processes of the given SeparateProcess"""
+        with self.lock:
+            self.pending.append(sp)
+            self.running[os.path.realpath(sp.working_dir)] = sp
+        os.write(self.wake_w, "x")
+
+    def cancel(self, working_dir):
+        """Kill the processes running in the given session dir, and
+           remove the dir. Return False if there are none.
+        """
+        with self.lock:
+            sp = self.running.get(os.path.realpath(working_dir))
+            if sp is None:
+                return False
+            self.cancelled.append(sp)
+        os.write(self.wake_w, "x")
+        return True
+
+    def sessions(self):
+        """Return the session dirs in which processes are running"""
+        with self.lock:
+            return self.running.keys()
+
+    def _run_callbacks(self):
+        while True:
+            callback = self.callbacks.get()
+            try:
+                callback()
+            except Exception:
+                print "error in process callback:", sys.exc_info()
+
+    def _schedule(self, delay, action, sp):
+        self.sequence += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.sequence,
+                                     action, sp, sp.run_count))
+
+    def _loop(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                print "error in process supervisor:", sys.exc_info()
+
+    def _step(self):
+        """Wait for output or for the next timer, and process them"""
+        timeout = None
+        if self.timers:
+            timeout = int(max(0, self.timers[0][0] - time.time()) * 1000) + 1
+
+        for fd, event in self.poller.poll(timeout):
+            if fd == self.wake_r:
+                os.read(self.wake_r, READ_SIZE)
+                with self.lock:
+                    pending, self.pending = self.pending, []
+                    cancelled, self.cancelled = self.cancelled, []
+                for sp in pending:
+                    self._guard(sp, self._start_next, sp)
+                for sp in cancelled:
+                    self._guard(sp, self._cancel, sp)
+            elif fd in self.by_fd:
+                self._guard(self.by_fd[fd], self._read, fd)
+
+        # Fire the timers that are due, ignoring those of processes that
+        # have moved on since they were set
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, action, sp, run = heapq.heappop(self.timers)
+            if sp.processes_running and sp.run_count == run:
+                self._guard(sp, action, sp)
+
+    def _guard(self, sp, action, *args):
+        """Call action with args, for sp. If this fails, sp is stopped, so
+           that the error is not repeated at each step.
+        """
+        try:
+            action(*args)
+        except Exception:
+            print "error when running {}:".format(sp.working_dir), \
+                sys.exc_info()
+            self._abort(sp)
+
+    def _abort(self, sp):
+        """Stop sp after an error in its handling"""
+        if self.by_fd.get(sp.fd) is sp:
+            self.poller.unregister(sp.fd)
+            del self.by_fd[sp.fd]
+        if not sp.processes_running:
+            return
+        sp.interrupted = True
+        for stop in (sp.close_stream, sp.kill):
+            try:
+                stop()
+            except Exception:
+                pass
+        sp.returncode = -1
+        try:
+            self._finish(sp)
+        except Exception:
+            pass
+
+    def _cancel(self, sp):
+        if sp.processes_running:
+            self._interrupt(sp, "<cancelled>")
+        discard(sp.working_dir)
+
+    def _start_next(self, sp):
+        """Launch the next command line of sp, or finish sp if there are
+           none left.
+        """
+        if sp.run_count >= len(sp.cmd_lines):
+            self._finish(sp)
+            return
+
+        sp.time = time.time()
+        try:
+            fd = sp.start_next()
+        except (OSError, IOError, socket.error), exception:
+            sp.write("{}\n".format(exception))
+            sp.returncode = 1
+            # The program did not run: it counts as interrupted
+            sp.interrupted = True
+            self._finish(sp)
+            return
+
+        self.by_fd[fd] = sp
+        self.poller.register(fd, select.POLLIN | select.POLLHUP)
+        self._schedule(TIMEOUT_SECONDS, self._timeout, sp)
+
+    def _read(self, fd):
+        sp = self.by_fd[fd]
+        data = os.read(fd, READ_SIZE)
+        if data:
+            sp.write(data)
+            if not sp.stream_done():
+                return
+
+        # End of output: wait for the process to exit
+        self._unregister(sp)
+        try:
+            fd = sp.resume()
+        except (OSError, IOError, socket.error), exception:
+            sp.write("{}\n".format(exception))
+            fd = None
+        if fd is not None:
+            self.by_fd[fd] = sp
+            self.poller.register(fd, select.POLLIN | select.POLLHUP)
+            return
+
+        sp.write_partial()
+        self._reap(sp)
+
+    def _unregister(self, sp):
+        fd = sp.fd
+        self.poller.unregister(fd)
+        del self.by_fd[fd]
+        sp.close_stream()
+
+    def _reap(self, sp):
+        returncode = sp.exit_status()
+        if returncode is None:
+            self._schedule(REAP_INTERVAL, self._reap, sp)
+            return
+
+        sp.returncode = returncode
+
+        # If the process returned nonzero, do not run the next process
+        if returncode != 0:
+            self._finish(sp)
+        else:
+            self._start_next(sp)
+
+    def _timeout(self, sp):
+        """The current process of sp took too long: interrupt it. If it
+           was started later than thought, for instance after waiting in
+           the queue of a worker, wait for the rest of its time.
+        """
+        remaining = sp.time + TIMEOUT_SECONDS - time.time()
+        if remaining > 0:
+            self._schedule(remaining, self._timeout, sp)
+            return
+        self._interrupt(sp, "<interrupted after timeout>")
+
+    def _interrupt(self, sp, message):
+        """Kill the current process of sp, ending its output with the
+           given message.
+        """
+        sp.interrupted = True
+        if self.by_fd.get(sp.fd) is sp:
+            self._unregister(sp)
+        sp.write_partial()
+        sp.write(message)
+        sp.kill()
+        if sp.on_kill:
+            self.callbacks.put(sp.on_kill)
+        sp.returncode = -1
+        self._finish(sp)
+
+    def _finish(self, sp):
+        """Write the status of sp, and notify its caller"""
+        with self.lock:
+            self.running.pop(os.path.realpath(sp.working_dir), None)
+        try:
+            sp.close()
+        finally:
+            # Even if the status could not be written, the caller must
+            # know, to give back what the processes held
+            sp.processes_running = False
+            if sp.on_finish:
+                self.callbacks.put(functools.partial(
+                    sp.on_finish, interrupted=sp.interrupted))
+
+
+def get_supervisor():
+    """Return the supervisor of this server process, starting it if needed"""
+    global supervisor
+    with supervisor_lock:
+        if supervisor is None:
+            supervisor = Supervisor()
+        return supervisor
+
 
 class SeparateProcess(object):
 
-    def __init__(self, cmd_lines, cwd):
+    def __init__(self, cmd_lines, cwd, on_finish=None, stdin_file=None,
+                 on_kill=None):
         """Launch the given command lines in sequence in the background.
            cmd_lines is a list of lists representing the command lines
            to launch.
            cwd is a directory in which the command line is run; this directory
            is erased when the processes are finished.
+           on_finish, if given, is called once the processes are finished,
+           with the keyword argument interrupted, whether they were stopped
+           by us, for instance cancelled, or could not be started, rather
+           than ending by themselves.
+           stdin_file, if given, is the name of a file to pass as the standard
+           input of the first command line.
+           on_kill, if given, is called without arguments when the processes
+           are killed, to kill those they started out of reach, for instance
+           in a container.
         """
         self.cmd_lines = cmd_lines
-        self.q = Queue()
+        self.on_finish = on_finish
+        self.on_kill = on_kill
+        self.stdin_file = stdin_file
         self.working_dir = cwd
         self.interrupted = False  # Whether we interrupted forcefully
+        self.interrupt_detected = False  # Whether the output was interrupted
         self.output_file = os.path.join(self.working_dir, 'output.txt')
         self.status_file = os.path.join(self.working_dir, 'status.txt')
         with open(self.status_file, 'wb') as f:
             f.write("")
+        self.output = open(self.output_file, 'ab')
+        self.output_lines = 0    # the number of lines written
+        self.output_bytes = 0    # the number of bytes written
+        self.tail = deque(maxlen=OUTPUT_TAIL_LINES)  # the last lines, once
+                                                     # the above are too many
+        self.elided = 0          # the number of lines not written
+        self.partial = ""        # the last line read, if incomplete
+        self.dropped = 0         # the length of it dropped, if it was too
+                                 # long
         self.p = None            # the current running process
+        self.fd = None           # the fd on which its output is read
+        self.run_count = 0       # the number of processes launched
+        self.returncode = None   # the return code of the last process
         self.time = time.time()  # the start time of the running process
         self.processes_running = True
 
-        t = Thread(target=self._enqueue_output)
-        t.daemon = True
-        t.start()
-
-        t2 = Thread(target=self._monitor_timeout)
-        t2.daemon = True
-        t2.start()
-
-    def _monitor_timeout(self):
-        """Monitor the running process, interrupting it if it takes too long"""
-
-        while self.processes_running:
-            if time.time() - self.time > TIMEOUT_SECONDS:
-                self.interrupted = True
-                with open(self.output_file, 'ab') as f:
-                    f.write("<interrupted after timeout>")
-                with open(self.status_file, 'wb') as f:
-                    f.write("-1")
-                # The current process took too long, kill it, first with
-                # sigabort, then with sigkill
-                try:
-                    self.p.kill()
-                    time.sleep(0.01)
-                    os.kill(self.p.pid, 9)
-                except OSError:
-                    pass
-                return
+        get_supervisor().add(self)
 
-            time.sleep(1.0)
-
-    def _enqueue_output(self):
-        """The function that reads the output from the process"""
-
-        # Launch each process in sequence, in the same task
-        for cmd in self.cmd_lines:
-            self.time = time.time()
+    def start_next(self):
+        """Launch the next command line, and return the fd on which to read
+           its output.
+        """
+        cmd = self.cmd_lines[self.run_count]
+        stdin = None
+        try:
+            if self.run_count == 0 and self.stdin_file:
+                stdin = open(self.stdin_file, 'rb')
+            self.run_count += 1
             self.p = subprocess.Popen(
                 cmd,
                 cwd=self.working_dir,
+                stdin=stdin,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                bufsize=1,
-                close_fds=True)
-
-            # Write the output line by line in the output file
-            for line in iter(self.p.stdout.readline, b''):
-                if self.interrupted:
-                    return
-                with open(self.output_file, 'ab') as f:
-                    f.write(line)
+                close_fds=True,
+                # In a process group of its own, to be killed with all the
+                # processes it starts
+                preexec_fn=os.setsid)
+        finally:
+            if stdin:
+                stdin.close()
+
+        self.fd = self.p.stdout.fileno()
+        return self.fd
+
+    def resume(self):
+        """Called at the end of the stream of the current command line.
+           Return a fd on which to continue reading its output, None if the
+           output is complete.
+        """
+        return None
 
-            # Write the return code
-            self.p.wait()
-            returncode = self.p.returncode
+    def stream_done(self):
+        """Return whether all the output of the current command line was
+           read before the end of its stream.
+        """
+        return False
 
-            # Cleanup
-            self.p.stdout.close()
+    def close_stream(self):
+        """Close the stream from which the output is read"""
+        self.p.stdout.close()
 
-            # If the process returned nonzero, do not run the next process
-            if returncode != 0:
-                break
+    def exit_status(self):
+        """Return the exit status of the current command line, None if it
+           is still running.
+        """
+        return self.p.poll()
+
+    def kill(self):
+        """Kill the current command line, and the processes it started"""
+        try:
+            os.killpg(self.p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def write(self, data):
+        """Write the output data of the process in the output file. The
+           mentions of the working dir are removed here, once, so that
+           readers can serve the file as-is.
+        """
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._write_record(line)
+
+        # Do not let a process accumulate one endless line: it is dropped,
+        # and only its length is kept until its end
+        if len(self.partial) > OUTPUT_RECORD_LENGTH:
+            self.dropped += len(self.partial)
+            self.partial = ""
+        self.output.flush()
+
+    def write_partial(self):
+        """Write the last line of output, if it was incomplete"""
+        if self.partial or self.dropped:
+            self._write_record(self.partial, end="")
+            self.partial = ""
+            self.output.flush()
+
+    def _write_record(self, record, end="\n"):
+        """Write a line of output, or in its place a valid record giving its
+           length if it is too long.
+        """
+        length = self.dropped + len(record)
+        if length > OUTPUT_RECORD_LENGTH:
+            record = json.dumps(
+                {"stderr": {"msg": OVERSIZED_STRING.format(length)}})
+        self.dropped = 0
+        self._write_line(record + end)
+
+    def _write_line(self, line):
+        if line.strip() == INTERRUPT_STRING:
+            self.interrupt_detected = True
+        line = line.replace(self.working_dir, '.')
+
+        # Past the budget of the session, only keep the last lines
+        if self.elided or self.output_lines >= OUTPUT_MAX_LINES or \
+                self.output_bytes + len(line) > OUTPUT_MAX_BYTES:
+            self.tail.append(line)
+            self.elided += 1
+            return
+
+        self.output.write(line)
+        self.output_lines += 1
+        self.output_bytes += len(line)
+
+    def write_tail(self):
+        """Write the last lines of output, after the marker of the lines
+           which were not kept.
+        """
+        if not self.elided:
+            return
+        elided = self.elided - len(self.tail)
+        if elided:
+            marker = {"stderr": {"msg": ELIDED_STRING.format(elided)}}
+            self.output.write(json.dumps(marker) + '\n')
+        for line in self.tail:
+            self.output.write(line)
+        self.tail.clear()
+
+    def close(self):
+        """Write the status file, now that the processes are finished"""
+        self.write_partial()
+        self.write_tail()
+        self.output.close()
 
         # Write the last return code in the status file
+        returncode = self.returncode
+        if self.interrupt_detected and not self.interrupted:
+            returncode = 1
         with open(self.status_file, 'wb') as f:
             f.write(str(returncode))
 
-        # When we have finished running processes, the monitor task should
-        # stop
         self.processes_running = False
 
 
@@ -126,7 +559,40 @@ class ProcessReader(object):
         self.working_dir = working_dir
         self.output_file = os.path.join(self.working_dir, 'output.txt')
         self.status_file = os.path.join(self.working_dir, 'status.txt')
-        self.interrupt_detected = False
+
+    def _status(self):
+        """Return the contents of the status file, None if the processes
+           are still running.
+        """
+        if not os.path.isfile(self.status_file):
+            return None
+
+        with open(self.status_file) as f:
+            status_text = f.read().strip()
+
+        return status_text or None
+
+    def touch(self):
+        """Record that a client is reading the session, see last_read"""
+        try:
+            os.utime(self.working_dir, None)
+        except OSError:
+            pass
+
+    def last_read(self):
+        """Return the time at which a client last read the session, or
+           its creation time. None if the session is gone.
+        """
+        try:
+            return os.path.getmtime(self.working_dir)
+        except OSError:
+            return None
+
+    def completed(self):
+        """Return whether the processes are completed. Unlike poll, this
+           leaves the working dir in place.
+        """
+        return self._status() is not None
 
     def poll(self):
         """ Check whether the process is still running.
@@ -137,26 +603,90 @@ class ProcessReader(object):
         if not os.path.isdir(self.working_dir):
             return 101
 
-        if not os.path.isfile(self.status_file):
-            return None
-
-        with open(self.status_file) as f:
-            status_text = f.read().strip()
-
-        if not status_text:
+        status_text = self._status()
+        if status_text is None:
             return None
         else:
-            # When all the processes are completed, remove the working dir
-            shutil.rmtree(self.working_dir)
-            if self.interrupt_detected:
-                return 1
+            # When all the processes are completed, remove the working dir,
+            # leaving the client time to read it again if it needs to
+            remove_later(self.working_dir)
             return int(status_text)
 
+    def read_from(self, cursor=0):
+        """Read the lines written after the given cursor.
+           cursor is the opaque value returned by the previous call, 0 to
+           read from the beginning.
+           Return a tuple (lines, cursor) where cursor is the value to pass
+           to the next call. Only complete lines are returned while the
+           processes are running.
+        """
+        if not os.path.isfile(self.output_file):
+            return [], cursor
+
+        with open(self.output_file, "rb") as f:
+            f.seek(cursor)
+            data = f.read()
+
+        if not data.endswith('\n') and self._status() is None:
+            # Leave the incomplete last line for the next call
+            data = data[:data.rfind('\n') + 1]
+
+        return data.splitlines(True), cursor + len(data)
+
+    def wait(self, cursor, timeout):
+        """Wait until there is output after cursor, the processes are
+           completed, or timeout seconds have passed.
+           Return True if there is something new for the reader.
+        """
+        deadline = time.time() + timeout
+        intervals = iter(WAIT_POLL_INTERVALS)
+        interval = next(intervals)
+        while True:
+            if not os.path.isdir(self.working_dir):
+                return True
+
+            # Only the size of the files is looked at, which costs one stat
+            # each and does not open them
+            try:
+                if os.path.getsize(self.output_file) > cursor:
+                    return True
+            except OSError:
+                pass
+
+            try:
+                if os.path.getsize(self.status_file) > 0:
+                    return True
+            except OSError:
+                pass
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = next(intervals, interval)
+
+    def follow(self, timeout):
+        """Yield the lines of output as they are written, until the
+           processes are completed. timeout is the maximum number of seconds
+           between two looks at the session files.
+        """
+        cursor = 0
+        while os.path.isdir(self.working_dir):
+            completed = self.completed()
+            lines, cursor = self.read_from(cursor)
+            for line in lines:
+                yield line
+            if completed:
+                return
+            self.wait(cursor, timeout)
+
     def read_lines(self, already_read=0):
         """Read all the available lines from the process.
            already_read indicates the number of lines that have already been
            read by the process.
            Return an empty list if there is nothing to read.
+
+           This reads the whole output at each call: prefer read_from.
         """
 
         # Custom debug codes, to debug application
@@ -166,18 +696,228 @@ class ProcessReader(object):
         if not os.path.isfile(self.output_file):
             return []
 
-        lines = []
         with open(self.output_file, "rb") as f:
-            for x in f.readlines():
-                # Doctor: remove the mentions of working dir from output
-                lines.append(x.replace(self.working_dir, '.'))
-
-                if x.strip() == INTERRUPT_STRING:
-                    self.interrupt_detected = True
+            lines = f.readlines()
 
         return lines[already_read:]
 
 
+def remove_session(working_dir):
+    """Remove the given session dir, on behalf of its reader. If the dir is
+       shared by several readers, working_dir may be a link to it: the dir
+       itself is only removed once all its readers are done.
+    """
+    shared = os.path.realpath(working_dir)
+    if leave_session(working_dir):
+        discard(shared)
+
+
+def leave_session(working_dir):
+    """Remove the reader of the given session dir, see remove_session.
+       Return whether it was the last reader of the dir.
+    """
+    shared = os.path.realpath(working_dir)
+    readers = os.path.join(shared, READERS_DIR)
+    if os.path.islink(working_dir):
+        os.remove(working_dir)
+
+    if os.path.isdir(readers):
+        try:
+            os.remove(os.path.join(readers, os.path.basename(working_dir)))
+        except OSError:
+            pass
+        try:
+            os.rmdir(readers)
+        except OSError:
+            # Other readers are still reading
+            return False
+
+    return True
+
+
+def cancel(working_dir):
+    """Kill the processes running in the given session dir, if any, and
+       remove the dir. Return False if there are none.
+    """
+    return supervisor is not None and supervisor.cancel(working_dir)
+
+
+def running_sessions():
+    """Return the session dirs in which processes are running"""
+    if supervisor is None:
+        return []
+    return supervisor.sessions()
+
+
+def remove_later(working_dir):
+    """Remove the given session dir with remove_session once TEARDOWN_GRACE
+       seconds have passed.
+    """
+    with teardown_lock:
+        teardown_queue.setdefault(working_dir, time.time() + TEARDOWN_GRACE)
+    start_teardown()
+
+
+def new_session_dir():
+    """Create a new session dir, return its name"""
+    return tempfile.mkdtemp(prefix=SESSION_PREFIX)
+
+
+def trash_ready(check_again=False):
+    """Return whether TRASH_DIR can be used, that is whether it is a dir of
+       ours which others cannot write to, creating it if needed. This is
+       only checked once, unless check_again.
+    """
+    global trash_usable
+    with teardown_lock:
+        if trash_usable is None or check_again:
+            try:
+                os.mkdir(TRASH_DIR, 0700)
+            except OSError:
+                # It exists already, or cannot be created
+                pass
+            try:
+                st = os.lstat(TRASH_DIR)
+                trash_usable = stat.S_ISDIR(st.st_mode) and \
+                    st.st_uid == os.getuid() and not st.st_mode & 0077
+            except OSError:
+                trash_usable = False
+            if not trash_usable:
+                print "the trash {} cannot be used".format(TRASH_DIR)
+        return trash_usable
+
+
+def discard(path):
+    """Remove the given dir right away: it is moved to TRASH_DIR, to be
+       deleted in the background with the others.
+    """
+    global trash_count
+    with teardown_lock:
+        trash_count += 1
+        target = os.path.join(TRASH_DIR, "{}.{}.{}".format(
+            os.path.basename(path), os.getpid(), trash_count))
+    start_teardown()
+
+    # If the move fails, the trash may have been removed: check it again
+    for check_again in (False, True):
+        if not trash_ready(check_again):
+            break
+        try:
+            os.rename(path, target)
+            return
+        except OSError, exception:
+            if exception.errno == errno.ENOENT and not os.path.lexists(path):
+                return
+
+    if os.path.islink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    else:
+        shutil.rmtree(path, True)
+
+
+def start_teardown():
+    """Start, if this wasn't done already, the task that removes the
+       session dirs given to remove_later, and empties the trash.
+    """
+    global teardown_started
+    with teardown_lock:
+        if teardown_started:
+            return
+        teardown_started = True
+
+    def teardown():
+        while True:
+            time.sleep(TEARDOWN_INTERVAL)
+            try:
+                remove_due_sessions()
+                empty_trash()
+            except Exception:
+                print "error when removing sessions:", sys.exc_info()
+
+    t = Thread(target=teardown)
+    t.daemon = True
+    t.start()
+
+
+def remove_due_sessions():
+    """Remove the session dirs given to remove_later whose time has come"""
+    now = time.time()
+    with teardown_lock:
+        due = [d for d, deadline in teardown_queue.items() if deadline <= now]
+        for working_dir in due:
+            del teardown_queue[working_dir]
+
+    for working_dir in due:
+        remove_session(working_dir)
+
+
+def empty_trash():
+    """Delete all that is in the trash"""
+    if not trash_ready():
+        return
+    try:
+        names = os.listdir(TRASH_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(TRASH_DIR, name)
+        try:
+            if os.path.islink(path):
+                os.remove(path)
+            else:
+                shutil.rmtree(path, True)
+        except OSError:
+            # Removed meanwhile by another server process
+            pass
+
+
+def record_failure(working_dir, message):
+    """Record in the given working dir that the processes could not be
+       launched, so that readers get the message and a failed status.
+    """
+    with open(os.path.join(working_dir, 'output.txt'), 'ab') as f:
+        f.write(message + "\n")
+    with open(os.path.join(working_dir, 'status.txt'), 'wb') as f:
+        f.write("1")
+
+
+def record_output(working_dir, output, status):
+    """Record in the given working dir the output and status of processes
+       which were not run, for instance because their output is known.
+    """
+    with open(os.path.join(working_dir, 'output.txt'), 'wb') as f:
+        f.write(output)
+    with open(os.path.join(working_dir, 'status.txt'), 'wb') as f:
+        f.write(str(status))
+
+
+def start_reaper():
+    """Start, if this wasn't done already, the task that periodically
+       cleans up the list of running processes.
+    """
+    global reaper_started
+    with reaper_lock:
+        if reaper_started:
+            return
+        reaper_started = True
+
+    def reap():
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            try:
+                cleanup_old_processes()
+                remove_stale_sessions()
+            except Exception:
+                print "error when cleaning up processes:", sys.exc_info()
+
+    t = Thread(target=reap)
+    t.daemon = True
+    t.start()
+
+
 def cleanup_old_processes():
     """Cleanup the list of running processes"""
     for a in ProgramRun.objects.all():
@@ -195,3 +935,31 @@ def cleanup_old_processes():
         else:
             print "deleting because dir has been cleared:", a.working_dir
             a.delete()
+
+
+def remove_stale_sessions():
+    """Remove the sessions completed for more than MAX_SESSION_AGE seconds,
+       which should have been removed by now, and the links to the shared
+       sessions which were removed.
+    """
+    now = time.time()
+    tempdir = tempfile.gettempdir()
+    for name in os.listdir(tempdir):
+        if not name.startswith(SESSION_PREFIX):
+            continue
+        path = os.path.join(tempdir, name)
+        status_file = os.path.join(path, 'status.txt')
+        try:
+            st = os.lstat(path)
+            if st.st_uid != os.getuid():
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                if not os.path.exists(path):
+                    os.remove(path)
+            elif stat.S_ISDIR(st.st_mode) and \
+                    os.path.getsize(status_file) and \
+                    now - os.path.getmtime(status_file) > MAX_SESSION_AGE:
+                discard(path)
+        except OSError:
+            # Not a session, or removed meanwhile
+            pass
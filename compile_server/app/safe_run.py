@@ -1,8 +1,9 @@
 """ This is a standalone Python script that runs its argument
     safely in a container.
 
-    At the moment it assumes that the container "safecontainer"
-    exists and is running.
+    At the moment it assumes that the container "safecontainer", or the
+    one named by the environment variable SAFECONTAINER, exists and is
+    running.
 """
 
 import os
@@ -10,7 +11,7 @@ import time
 import sys
 import subprocess
 
-CONT = 'safecontainer'
+CONT = os.environ.get('SAFECONTAINER', 'safecontainer')
 INTERRUPT_STRING = '<interrupted>'
 DEBUG = False
 
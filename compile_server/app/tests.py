@@ -1,6 +1,570 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Event
+
 from django.test import TestCase
 
-# Create your tests here.
+from compile_server.app import backends, checker, process_handling
+from compile_server.app.admission import Admission, RUNNING, QUEUED, \
+    REJECTED
+from compile_server.app.backends import Backend, Dispatcher, Unreachable, \
+    CONSISTENT_HASH
+from compile_server.app.coalescing import Coalescer
+from compile_server.app.concurrency import AdaptiveLimit, DECREASE_FACTOR, \
+    INCREASE_STEP, MIN_SAMPLES
+from compile_server.app.models import ToolOutput
+from compile_server.app.process_handling import ProcessReader
+from compile_server.app.throttling import RateLimiter, FairShare, \
+    ADDRESS_ALLOWANCE
+
+
+def use_own_trash(test):
+    """Make the dirs discarded during the given test go to a trash of its
+       own, which is not emptied in the background.
+    """
+    trash = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, trash, True)
+    for name, value in (('TRASH_DIR', os.path.join(trash, "trash")),
+                        ('trash_usable', None),
+                        ('start_teardown', lambda: None)):
+        test.addCleanup(setattr, process_handling, name,
+                        getattr(process_handling, name))
+        setattr(process_handling, name, value)
+
+
+class AdmissionTestCase(TestCase):
+
+    def setUp(self):
+        self.launched = []
+
+    def launcher(self, identifier):
+        return lambda: self.launched.append(identifier)
+
+    def test_acquire_and_release(self):
+        admission = Admission(2)
+        self.assertTrue(admission.acquire())
+        self.assertTrue(admission.acquire())
+        self.assertFalse(admission.acquire())
+        self.assertEqual(admission.demand(), 2)
+
+        admission.release()
+        self.assertEqual(admission.demand(), 1)
+        self.assertTrue(admission.acquire())
+
+    def test_submit_and_release(self):
+        admission = Admission(2, queue_depth=1)
+        self.assertEqual(admission.submit("a", self.launcher("a")), RUNNING)
+        self.assertEqual(admission.submit("b", self.launcher("b")), RUNNING)
+        self.assertEqual(admission.submit("c", self.launcher("c")), QUEUED)
+        self.assertEqual(admission.submit("d", self.launcher("d")), REJECTED)
+        self.assertEqual(self.launched, ["a", "b"])
+        self.assertEqual(admission.position("c"), 1)
+        self.assertEqual(admission.demand(), 3)
+
+        admission.release()
+        self.assertEqual(self.launched, ["a", "b", "c"])
+        self.assertIsNone(admission.position("c"))
+        self.assertEqual(admission.demand(), 2)
+
+    def test_failed_launch_gives_back_the_slot(self):
+        admission = Admission(1)
+
+        def fail():
+            raise IOError("cannot launch")
+
+        admission.submit("a", fail)
+        self.assertEqual(admission.submit("b", self.launcher("b")), RUNNING)
+
+    def test_remove(self):
+        admission = Admission(1, queue_depth=2)
+        cancelled = []
+        admission.submit("a", self.launcher("a"))
+        admission.submit("b", self.launcher("b"),
+                         cancelled=lambda: cancelled.append("b"))
+        self.assertTrue(admission.remove("b"))
+        self.assertFalse(admission.remove("b"))
+        self.assertEqual(cancelled, ["b"])
+
+        admission.release()
+        self.assertEqual(self.launched, ["a"])
+        self.assertEqual(admission.demand(), 0)
+
+    def test_lanes_are_served_by_weight(self):
+        admission = Admission(1, queue_depth=8,
+                              lanes={"run": (3, 1.0), "prove": (1, 1.0)})
+        admission.submit("run", self.launcher("run"), "run")
+        for index in range(4):
+            admission.submit("run", self.launcher("run"), "run")
+            admission.submit("prove", self.launcher("prove"), "prove")
+
+        for index in range(4):
+            admission.release(lane=self.launched[-1])
+        self.assertEqual(sorted(self.launched[1:]),
+                         ["prove", "run", "run", "run"])
+
+    def test_lane_share(self):
+        admission = Admission(4, queue_depth=4,
+                              lanes={"prove": (1, 0.5)})
+        for index in range(3):
+            admission.submit("prove", self.launcher("prove"), "prove")
+        self.assertEqual(admission.submit("run", self.launcher("run"), "run"),
+                         RUNNING)
+        self.assertEqual(self.launched, ["prove", "prove", "run"])
+
+
+class ProcessReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.reader = ProcessReader(self.working_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir, True)
+
+    def write(self, name, data):
+        with open(os.path.join(self.working_dir, name), 'ab') as f:
+            f.write(data)
+
+    def test_read_from(self):
+        self.assertEqual(self.reader.read_from(0), ([], 0))
+
+        self.write('status.txt', b"")
+        self.write('output.txt', b"one\ntw")
+        lines, cursor = self.reader.read_from(0)
+        self.assertEqual(lines, [b"one\n"])
+        self.assertEqual(cursor, 4)
+
+        # The incomplete line is read once complete
+        self.write('output.txt', b"o\nthree\n")
+        lines, cursor = self.reader.read_from(cursor)
+        self.assertEqual(lines, [b"two\n", b"three\n"])
+        self.assertEqual(self.reader.read_from(cursor), ([], cursor))
+
+    def test_read_from_completed(self):
+        self.write('output.txt', b"one\nlast")
+        self.write('status.txt', b"0")
+        lines, cursor = self.reader.read_from(0)
+        self.assertEqual(lines, [b"one\n", b"last"])
+        self.assertEqual(cursor, 8)
+
+
+class ThrottlingTestCase(TestCase):
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(1, 2)
+        client = ("10.0.0.1", "session")
+        self.assertEqual(limiter.take(client), 0)
+        self.assertEqual(limiter.take(client), 0)
+        self.assertGreater(limiter.take(client), 0)
+
+        # Another client behind the same address has its own bucket
+        self.assertEqual(limiter.take(("10.0.0.1", "other")), 0)
+
+    def test_rate_limiter_address(self):
+        limiter = RateLimiter(1, 2)
+        client = ("10.0.0.2", None)
+        taken = [limiter.take(client)
+                 for index in range(3 * ADDRESS_ALLOWANCE)]
+        self.assertEqual(taken.count(0), 2 * ADDRESS_ALLOWANCE)
+
+    def test_fair_share(self):
+        fair_share = FairShare(4, 1)
+        first = ("10.0.0.1", "first")
+        second = ("10.0.0.2", "second")
+        self.assertEqual(sum(fair_share.acquire(first) for index in range(8)),
+                         4)
+
+        # With two active addresses, the share is halved
+        self.assertTrue(fair_share.acquire(second))
+        self.assertTrue(fair_share.acquire(second))
+        self.assertFalse(fair_share.acquire(second))
+
+        fair_share.release(second)
+        self.assertTrue(fair_share.acquire(second))
+
+    def test_fair_share_capacity(self):
+        fair_share = FairShare(1, 1)
+        client = ("10.0.0.1", "first")
+        self.assertTrue(fair_share.acquire(client))
+        self.assertFalse(fair_share.acquire(client))
+        fair_share.set_capacity(2)
+        self.assertTrue(fair_share.acquire(client))
+
+
+class AdaptiveLimitTestCase(TestCase):
+
+    def setUp(self):
+        self.applied = []
+        self.limit = AdaptiveLimit(40, 4, 100, self.applied.append,
+                                   host_load=False)
+
+    def window(self, ratio, demand):
+        self.limit.ratios = [ratio] * MIN_SAMPLES
+        self.limit.demand = demand
+        return self.limit._adjust()
+
+    def test_increase_when_all_slots_are_used(self):
+        self.assertEqual(self.window(1.0, 40), 40 + INCREASE_STEP)
+        self.assertEqual(self.limit.baseline, 1.0)
+
+    def test_unchanged_when_slots_are_left(self):
+        self.assertIsNone(self.window(1.0, 10))
+        self.assertEqual(self.limit.limit, 40)
+
+    def test_decrease_when_slower(self):
+        self.window(1.0, 10)
+        self.assertEqual(self.window(3.0, 40), int(40 * DECREASE_FACTOR))
+
+    def test_bounds(self):
+        self.limit.limit = 100
+        self.assertIsNone(self.window(1.0, 100))
+        self.limit.limit = 4
+        self.limit.baseline = 1.0
+        self.assertIsNone(self.window(10.0, 4))
+
+
+class FakeBackend(Backend):
+    """A backend which fails with the given error, if any, or records the
+       programs that it starts.
+    """
+
+    def __init__(self, name, error=None):
+        super(FakeBackend, self).__init__(name)
+        self.error = error
+        self.started = []
+
+    def start(self, tempd, mode, lab, on_finish):
+        if self.error:
+            raise self.error
+        self.started.append(tempd)
+
+
+class DispatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.first = FakeBackend("first")
+        self.second = FakeBackend("second")
+
+    def on_finish(self, launched=True, interrupted=False):
+        pass
+
+    def test_least_loaded(self):
+        dispatcher = Dispatcher([self.first, self.second])
+        self.first.in_flight = 2
+        self.assertIs(dispatcher.choose(), self.second)
+        self.assertIs(dispatcher.choose(exclude=[self.second]), self.first)
+        self.assertIsNone(dispatcher.choose(exclude=[self.first,
+                                                     self.second]))
+
+    def test_consistent_hash(self):
+        dispatcher = Dispatcher([self.first, self.second], CONSISTENT_HASH)
+        backend = dispatcher.choose("key")
+        self.assertIs(dispatcher.choose("key"), backend)
+
+        # A backend which is down is skipped, unless all are
+        backend.down_until = time.time() + 60
+        other = dispatcher.choose("key")
+        self.assertIsNot(other, backend)
+        other.down_until = time.time() + 60
+        self.assertIs(dispatcher.choose("key"), backend)
+
+    def test_unreachable_backend(self):
+        self.first.error = Unreachable("refused")
+        dispatcher = Dispatcher([self.first, self.second])
+        dispatcher.launch("session", "run", None, self.on_finish)
+        self.assertEqual(self.second.started, ["session"])
+        self.assertEqual(self.first.in_flight, 0)
+        self.assertFalse(self.first.up(time.time()))
+        self.assertEqual(self.first.failures, 1)
+
+        # It is tried again once its backoff has passed
+        self.first.error = None
+        self.first.down_until = 0
+        dispatcher.launch("other", "run", None, self.on_finish)
+        self.assertEqual(self.first.started, ["other"])
+        self.assertEqual(self.first.failures, 0)
+
+    def test_no_backend_reachable(self):
+        self.first.error = self.second.error = Unreachable("refused")
+        dispatcher = Dispatcher([self.first, self.second])
+        self.assertRaises(Unreachable, dispatcher.launch, "session", "run",
+                          None, self.on_finish)
+
+
+class SupervisorTestCase(TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.finished = Event()
+        self.interrupted = None
+        self.patched = {}
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(process_handling, name, value)
+        shutil.rmtree(self.working_dir, True)
+
+    def patch(self, name, value):
+        """Set the given constant of process_handling for this test"""
+        self.patched.setdefault(name, getattr(process_handling, name))
+        setattr(process_handling, name, value)
+
+    def on_finish(self, interrupted=False):
+        self.interrupted = interrupted
+        self.finished.set()
+
+    def run_lines(self, cmd_lines):
+        """Run cmd_lines, and return their output and status"""
+        process_handling.SeparateProcess(cmd_lines, self.working_dir,
+                                         on_finish=self.on_finish)
+        self.assertTrue(self.finished.wait(10))
+        with open(os.path.join(self.working_dir, 'output.txt'), 'rb') as f:
+            output = f.read()
+        with open(os.path.join(self.working_dir, 'status.txt'), 'rb') as f:
+            return output, f.read()
+
+    def test_command_lines_in_sequence(self):
+        self.assertEqual(self.run_lines([["echo", "one"], ["echo", "two"]]),
+                         (b"one\ntwo\n", b"0"))
+        self.assertFalse(self.interrupted)
+
+    def test_failure_stops_the_sequence(self):
+        self.assertEqual(self.run_lines([["false"], ["echo", "two"]]),
+                         (b"", b"1"))
+        self.assertFalse(self.interrupted)
+
+    def test_timeout(self):
+        self.patch('TIMEOUT_SECONDS', 0.5)
+        output, status = self.run_lines([["sleep", "10"]])
+        self.assertEqual(output, b"<interrupted after timeout>")
+        self.assertEqual(status, b"-1")
+        self.assertTrue(self.interrupted)
+
+    def test_launch_failure(self):
+        # A program which did not run counts as interrupted
+        output, status = self.run_lines([["/nonexistent/program"]])
+        self.assertEqual(status, b"1")
+        self.assertTrue(self.interrupted)
+
+    def python(self, code):
+        """Return the command line which runs the given Python code"""
+        return [sys.executable, "-c", code]
+
+    def test_oversized_record(self):
+        self.patch('OUTPUT_RECORD_LENGTH', 100)
+        output, status = self.run_lines([self.python(
+            "import sys; sys.stdout.write('x' * 500 + '\\nok\\n')")])
+        record = {"stderr": {"msg": process_handling.OVERSIZED_STRING.format(
+            500)}}
+        self.assertEqual(output.splitlines(), [json.dumps(record), b"ok"])
+
+    def test_output_budget(self):
+        self.patch('OUTPUT_MAX_LINES', 10)
+        self.patch('OUTPUT_TAIL_LINES', 3)
+        output, status = self.run_lines([self.python(
+            "for i in range(20): print(i)")])
+        marker = {"stderr": {"msg": process_handling.ELIDED_STRING.format(7)}}
+        self.assertEqual(output.splitlines(),
+                         [str(i) for i in range(10)] + [json.dumps(marker)] +
+                         [str(i) for i in range(17, 20)])
+
+
+class SessionTestCase(TestCase):
+
+    def setUp(self):
+        use_own_trash(self)
+
+        self.coalescer = Coalescer()
+        self.shared = tempfile.mkdtemp()
+        self.follower = tempfile.mkdtemp()
+        self.finished = self.coalescer.lead("fingerprint", self.shared)
+
+    def tearDown(self):
+        for path in (self.follower, self.shared):
+            if os.path.islink(path):
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path, True)
+
+    def test_attach(self):
+        self.assertFalse(self.coalescer.attach("other", self.follower))
+        self.assertTrue(self.coalescer.attach("fingerprint", self.follower))
+        self.assertTrue(os.path.islink(self.follower))
+        self.assertEqual(os.path.realpath(self.follower),
+                         os.path.realpath(self.shared))
+
+        # Once the leader is finished, its run is no longer shared
+        self.finished()
+        late = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, late, True)
+        self.assertFalse(self.coalescer.attach("fingerprint", late))
+
+    def test_leave_session(self):
+        self.coalescer.attach("fingerprint", self.follower)
+        self.assertFalse(process_handling.leave_session(self.follower))
+        self.assertFalse(os.path.lexists(self.follower))
+        self.assertTrue(os.path.isdir(self.shared))
+        self.assertTrue(process_handling.leave_session(self.shared))
+
+    def test_remove_session(self):
+        self.coalescer.attach("fingerprint", self.follower)
+        process_handling.remove_session(self.shared)
+        self.assertTrue(os.path.isdir(self.shared))
+        process_handling.remove_session(self.follower)
+        self.assertFalse(os.path.lexists(self.shared))
+
+    def test_discard(self):
+        process_handling.discard(self.shared)
+        self.assertFalse(os.path.lexists(self.shared))
+        self.assertEqual(len(os.listdir(process_handling.TRASH_DIR)), 1)
+        process_handling.empty_trash()
+        self.assertEqual(os.listdir(process_handling.TRASH_DIR), [])
+
+        # A dir which is already gone is ignored
+        process_handling.discard(self.shared)
+
+    def test_trash_not_ours(self):
+        elsewhere = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, elsewhere, True)
+        open(os.path.join(elsewhere, "kept"), 'wb').close()
+        os.symlink(elsewhere, process_handling.TRASH_DIR)
+
+        # The dir is removed without the trash, which is left alone
+        process_handling.discard(self.shared)
+        self.assertFalse(os.path.lexists(self.shared))
+        process_handling.empty_trash()
+        self.assertEqual(os.listdir(elsewhere), ["kept"])
+
+
+class PrecomputedOutputTestCase(TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.dispatcher = backends.dispatcher
+
+    def tearDown(self):
+        backends.dispatcher = self.dispatcher
+        shutil.rmtree(self.working_dir, True)
+
+    def read(self, name):
+        with open(os.path.join(self.working_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_serve_precomputed_output(self):
+        ToolOutput.objects.create(mode="run", fingerprint="f" * 40, status=0,
+                                  output="hello\n")
+        self.assertFalse(checker.serve_precomputed_output(self.working_dir,
+                                                          "0" * 40))
+        self.assertTrue(checker.serve_precomputed_output(self.working_dir,
+                                                         "f" * 40))
+        self.assertEqual(self.read('output.txt'), b"hello\n")
+        self.assertEqual(self.read('status.txt'), b"0")
+
+    def test_launch_failure_is_not_a_run(self):
+        backends.dispatcher = Dispatcher(
+            [FakeBackend("failing", OSError("cannot launch"))])
+        ran = []
+        self.assertTrue(checker.admission.acquire("run"))
+        checker.launch_program(self.working_dir, "run", None, ran.append)
+        self.assertEqual(ran, [False])
+        self.assertEqual(self.read('status.txt'), b"1")
+
+
+class StaleSessionTestCase(TestCase):
+
+    def setUp(self):
+        use_own_trash(self)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir, True)
+        self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+        tempfile.tempdir = tempdir
+
+    def session(self, name, status, age):
+        """Create a dir with the given status, completed age seconds ago"""
+        status_file = os.path.join(tempfile.gettempdir(), name, 'status.txt')
+        os.mkdir(os.path.dirname(status_file))
+        with open(status_file, 'wb') as f:
+            f.write(status)
+        os.utime(status_file, (time.time() - age, time.time() - age))
+
+    def test_remove_stale_sessions(self):
+        prefix = process_handling.SESSION_PREFIX
+        stale = process_handling.MAX_SESSION_AGE + 10
+        self.session(prefix + "stale", b"0", stale)
+        self.session(prefix + "recent", b"0", 0)
+        self.session(prefix + "running", b"", stale)
+        self.session("other", b"0", stale)
+        for name in (prefix + "gone", "other_link"):
+            os.symlink("/nonexistent",
+                       os.path.join(tempfile.gettempdir(), name))
+
+        process_handling.remove_stale_sessions()
+        self.assertEqual(sorted(os.listdir(tempfile.gettempdir())),
+                         ["other", "other_link", prefix + "recent",
+                          prefix + "running"])
+
+
+class CancelTestCase(TestCase):
+
+    def setUp(self):
+        use_own_trash(self)
+
+        self.admission = checker.admission
+        checker.admission = Admission(1, queue_depth=2)
+        self.sessions = []
+
+    def tearDown(self):
+        checker.admission = self.admission
+        for path in self.sessions:
+            shutil.rmtree(path, True)
+
+    def session(self, status=None):
+        """Return the identifier of a new session, with the given status if
+           it is completed.
+        """
+        working_dir = process_handling.new_session_dir()
+        self.sessions.append(working_dir)
+        if status is not None:
+            with open(os.path.join(working_dir, 'status.txt'), 'wb') as f:
+                f.write(status)
+        return os.path.basename(working_dir)
+
+    def exists(self, identifier):
+        return os.path.isdir(os.path.join(tempfile.gettempdir(), identifier))
+
+    def test_cancel_session(self):
+        completed = self.session(b"0")
+        self.assertTrue(checker.cancel_session(completed))
+        self.assertFalse(self.exists(completed))
+        self.assertFalse(checker.cancel_session(completed))
+
+        # Only the dirs of sessions are touched
+        other = self.session()
+        self.assertFalse(checker.cancel_session(other))
+        self.assertTrue(self.exists(other))
+        self.assertFalse(checker.cancel_session("../" + other))
+
+    def test_cancel_abandoned(self):
+        cancelled = []
+        checker.admission.submit("running", lambda: None)
+        abandoned = self.session()
+        read = self.session()
+        for identifier in (abandoned, read):
+            checker.admission.submit(
+                identifier, lambda: None,
+                cancelled=lambda identifier=identifier:
+                    cancelled.append(identifier))
+
+        # No client has read the first session for long
+        os.utime(os.path.join(tempfile.gettempdir(), abandoned), (0, 0))
+        checker.cancel_abandoned()
+        self.assertEqual(cancelled, [abandoned])
+        self.assertFalse(self.exists(abandoned))
+        self.assertTrue(self.exists(read))
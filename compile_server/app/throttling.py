@@ -0,0 +1,157 @@
+# This package limits what each client can ask of the server, so that one
+# client cannot take the capacity of the server from the others.
+#
+# RateLimiter gives each client a token bucket: each request takes a token,
+# and the tokens come back at a steady rate up to a burst. FairShare limits
+# the number of programs that each client has running or queued to its
+# share of the slots, which shrinks as more clients are active.
+#
+# A client is known by its address, and by its session cookie when it has
+# one, so that the clients behind one address, for instance those of a
+# school, are told apart. As the cookie is chosen by the client, the clients
+# of an address are also limited together, ADDRESS_ALLOWANCE times as much
+# as one client. A client without a cookie gets the allowance of its
+# address.
+#
+# Both are kept in the memory of this server process.
+
+import time
+from threading import Lock
+
+from django.conf import settings
+
+MAX_CLIENTS = 10000
+# The number of clients beyond which those with full buckets are forgotten
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+# The addresses of the proxies trusted to give the address of the client
+
+ADDRESS_ALLOWANCE = 10
+# The factor by which the limits of an address, shared by the clients
+# behind it, exceed those of one client
+
+MAX_SESSION_LENGTH = 64
+# The number of characters of the session cookie kept to know the client
+
+
+def address_of(request):
+    """Return the address of the client which sent the request"""
+    address = request.META.get('REMOTE_ADDR', '')
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded and address in LOCAL_ADDRESSES:
+        # The address of the client, as seen by the proxy in front of us
+        return forwarded.split(',')[-1].strip()
+    return address
+
+
+def client_of(request):
+    """Return the key of the client which sent the request: the pair of
+       its address and of its session cookie, None if it has none.
+    """
+    session = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    return (address_of(request),
+            session[:MAX_SESSION_LENGTH] if session else None)
+
+
+def limits_of(client):
+    """Return the keys by which the given client is limited, each with the
+       factor of its allowance.
+    """
+    address, session = client
+    keys = [((address, None), ADDRESS_ALLOWANCE)]
+    if session is not None:
+        keys.append((client, 1))
+    return keys
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst):
+        """rate is the number of requests per second allowed to a client
+           in the long run, burst the number it can make at once.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.buckets = {}  # (tokens, time, factor) for each key, see
+                           # limits_of
+        self.lock = Lock()
+
+    def take(self, client):
+        """Take a token for a request of the client, see client_of, from
+           each of its buckets.
+           Return 0 if there was one, otherwise the number of seconds
+           after which there will be one.
+        """
+        now = time.time()
+        with self.lock:
+            levels = [(key, factor, self._level(key, factor, now))
+                      for key, factor in limits_of(client)]
+            wait = max(int((1 - tokens) / (self.rate * factor)) + 1
+                       if tokens < 1 else 0
+                       for key, factor, tokens in levels)
+            for key, factor, tokens in levels:
+                if key not in self.buckets and \
+                        len(self.buckets) >= MAX_CLIENTS:
+                    self._forget(now)
+                self.buckets[key] = (tokens if wait else tokens - 1, now,
+                                     factor)
+            return wait
+
+    def _level(self, key, factor, now):
+        """Return the number of tokens in the bucket of the key"""
+        tokens, last, _ = self.buckets.get(
+            key, (self.burst * factor, now, factor))
+        return min(self.burst * factor,
+                   tokens + (now - last) * self.rate * factor)
+
+    def _forget(self, now):
+        """Forget the clients whose buckets are full again"""
+        for key, (tokens, last, factor) in self.buckets.items():
+            if self._level(key, factor, now) >= self.burst * factor:
+                del self.buckets[key]
+
+
+class FairShare(object):
+
+    def __init__(self, capacity, minimum):
+        """capacity is the number of programs shared by the clients, and
+           minimum the number that a client may always have.
+        """
+        self.capacity = capacity
+        self.minimum = minimum
+        self.programs = {}  # the number of programs of each key of an
+                            # active client, see limits_of
+        self.lock = Lock()
+
+    def set_capacity(self, capacity):
+        """Change the number of programs shared by the clients"""
+        with self.lock:
+            self.capacity = capacity
+
+    def acquire(self, client):
+        """Count a new program of the client, see client_of. Return False
+           if the client, or its address, already has its share.
+        """
+        keys = limits_of(client)
+        with self.lock:
+            # The share is that of each active address
+            active = len([key for key in self.programs if key[1] is None])
+            if keys[0][0] not in self.programs:
+                active += 1
+            share = max(self.minimum, self.capacity // active)
+            for key, factor in keys:
+                if self.programs.get(key, 0) >= share * factor:
+                    return False
+            for key, factor in keys:
+                self.programs[key] = self.programs.get(key, 0) + 1
+            return True
+
+    def release(self, client):
+        """Count one less program for the client"""
+        with self.lock:
+            for key, factor in limits_of(client):
+                count = self.programs.get(key, 0) - 1
+                if count > 0:
+                    self.programs[key] = count
+                else:
+                    self.programs.pop(key, None)
@@ -43,9 +43,9 @@ class ResourceSet(viewsets.ModelViewSet):
     serializer_class = ResourceSerializer
 
 
-def CrossDomainResponse(data=None):
+def CrossDomainResponse(data=None, headers=None, status=None):
     """Return a response which accepts cross-domain queries"""
-    r = Response(data)
+    r = Response(data, status=status, headers=headers)
     r["Access-Control-Allow-Origin"] = "*"
     return r
 
@@ -38,6 +38,15 @@ urlpatterns = [
     # Get the current running output of a given program
     url(r'^check_output/', checker.check_output),
 
+    # Same as check_output, waiting until there is new output
+    url(r'^wait_output/', checker.wait_output),
+
+    # Stop a program whose output is no longer wanted
+    url(r'^cancel_program/', checker.cancel_program),
+
+    # Get the state of the scheduling of the programs
+    url(r'^scheduler_status/', checker.scheduler_status),
+
     # Get a list of the examples
     url(r'^examples/', views.examples),
 
@@ -1,10 +1,17 @@
 #!/usr/bin/env sh
 
-# Kill all old processes
-lxc exec safecontainer -- killall  -u unprivileged --older-than 30s -signal KILL
+for c in ${SAFECONTAINERS:-safecontainer} ; do
+    # Kill all old processes
+    lxc exec $c -- killall  -u unprivileged --older-than 30s -signal KILL
 
-# Delete all old directories, both in container and locally
-lxc exec safecontainer -- find /tmp/ -mindepth 1  -type d -mmin +1 -exec rm -rf {}  \;
+    # Delete all old directories in the container
+    lxc exec $c -- find /tmp/ -mindepth 1  -type d -mmin +1 -exec rm -rf {}  \;
+
+    # Delete the finished sessions
+    lxc exec $c -- find /workspace/trash/ -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+done
+
+# Delete all old directories locally
 find /tmp/ -mindepth 1  -type d -mmin +1 -exec rm -rf {}  \;
 
 (if [ -d /webapps/compile_server/bin/ ] ; then
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+""" This is a daemon which runs in the container, and runs the jobs sent
+    by the server in place of "lxc exec ... python run.py": this saves the
+    cost of lxc exec, su and of starting the interpreter for each job.
+
+    It listens on AGENT_SOCKET, which the server reaches through an LXD
+    proxy device (see the infrastructure Makefile). The protocol is one
+    JSON object per line. The server sends a job:
+
+        {"identifier": <name of the session>,
+         "files": [{"basename": <name>, "contents": <text>}, ...],
+         "mode": <mode>, "lab": <lab or null>, "cli": [<args>, ...]}
+
+    and receives the records that run.py prints for this job, followed by
+
+        {"status": <exit status>}
+
+    after which the connection can be used for the next job. The job is
+    killed if the server closes the connection before it is finished.
+    Without "files", the job runs on the existing session: this is how
+    run.py hands its jobs over to the agent.
+
+    The connections are served by a pool of pre-forked workers which have
+    imported run.py already; each job runs in a process forked from its
+    worker, so that it can be killed with all its children. Workers are
+    replaced after a number of jobs.
+
+    A process of its own deletes the sessions that run.py moved to its
+    trash once finished.
+
+    This is meant to be run as user "runner".
+"""
+
+import argparse
+import codecs
+import json
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import run
+
+AGENT_SOCKET = run.POOL_SOCKET
+SESSIONS_DIR = "/workspace/sessions"
+
+POOL_SIZE = 64
+# The default number of workers, each serving one connection at a time; the
+# server runs at most AGENT_POOL_SIZE jobs at the same time in a container
+# (see compile_server/app/containers.py), which must not be more
+
+MAX_JOBS_PER_WORKER = 200
+# The default number of jobs after which a worker is replaced, to bound
+# the effect of leaks
+
+IDLE_TIMEOUT = 10
+# Number of seconds after which an idle connection is closed, making its
+# worker available to other connections
+
+LISTEN_BACKLOG = 512
+# The number of connections waiting for a worker
+
+JOB_POLL_INTERVAL = 0.1
+# Number of seconds between two checks of a running job
+
+ACCEPT_WAIT = 0.05
+# Number of seconds for which an idle worker lets a free worker take a new
+# connection before looking again
+
+SWEEP_INTERVAL = 5
+# Number of seconds between two deletions of the sessions in the trash
+
+
+def prepare_session(job):
+    """Write the files of job in a new session dir, return its name.
+       Jobs without files run in the existing session dir.
+    """
+    identifier = os.path.basename(job["identifier"])
+    if not identifier:
+        raise ValueError("invalid identifier")
+
+    workdir = os.path.join(SESSIONS_DIR, identifier)
+    if "files" not in job:
+        if not os.path.isdir(workdir):
+            raise ValueError("no session {}".format(identifier))
+        return workdir
+
+    os.mkdir(workdir)
+    os.chmod(workdir, 0o755)
+
+    for f in job["files"]:
+        name = os.path.join(workdir, os.path.basename(f["basename"]))
+        with codecs.open(name, "w", "utf-8") as fd:
+            fd.write(f["contents"])
+        os.chmod(name, 0o755)
+
+    if job.get("cli"):
+        with open(os.path.join(workdir, run.CLI_FILE), "w") as fd:
+            fd.write(" ".join(job["cli"]))
+
+    return workdir
+
+
+def start_job(workdir, mode, lab, fd):
+    """Fork a process running the job as run.py would, with its output
+       going to fd. Return its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    status = 0
+    try:
+        # Have a process group of our own, so that the job can be killed
+        # with all its children
+        os.setsid()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+
+        # print_console reads the working dir from the module
+        run.workdir = workdir
+        run.safe_run(workdir, mode, lab)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class Connection(object):
+    """A connection from the server, on which jobs are received"""
+
+    def __init__(self, sock, listener, free):
+        self.sock = sock
+        self.listener = listener
+        self.free = free  # the shared count of the workers waiting for a
+                          # connection
+        self.rfile = sock.makefile("rb")
+
+    def serve(self, max_jobs):
+        """Run the jobs received on the connection, until it is closed or
+           idle for IDLE_TIMEOUT seconds, or max_jobs jobs were run.
+           An idle connection is also dropped when another connection waits
+           and no worker is free to take it.
+           Return the number of jobs run.
+        """
+        jobs = 0
+        while jobs < max_jobs:
+            if not self.wait_request():
+                break
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            jobs += 1
+            try:
+                job = json.loads(line)
+                workdir = prepare_session(job)
+            except Exception:
+                self.send({"internal_error": {
+                    "msg": "invalid job: {}".format(traceback.format_exc())}})
+                self.send({"status": 1})
+                continue
+
+            pid = start_job(workdir, job["mode"], job.get("lab"),
+                            self.sock.fileno())
+            status = self.wait_job(pid)
+            if status is None:
+                # The server has gone away
+                break
+            self.send({"status": status})
+
+        return jobs
+
+    def wait_request(self):
+        """Wait for the server to send a job on the connection. Return
+           False if the connection is to be dropped instead.
+        """
+        deadline = time.time() + IDLE_TIMEOUT
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select(
+                [self.sock, self.listener], [], [], remaining)
+            if self.sock in readable:
+                return True
+            if readable and self.free.value == 0:
+                # A connection waits, and only this worker can take it
+                return False
+            if readable:
+                # A free worker is about to accept the connection
+                time.sleep(ACCEPT_WAIT)
+
+    def wait_job(self, pid):
+        """Wait for the job running in pid. Return its exit status, or None
+           if the connection was closed in the meantime.
+        """
+        while True:
+            readable, _, _ = select.select(
+                [self.sock], [], [], JOB_POLL_INTERVAL)
+            if readable and not self.sock.recv(1, socket.MSG_PEEK):
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+                return None
+
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                if os.WIFSIGNALED(status):
+                    return -os.WTERMSIG(status)
+                return os.WEXITSTATUS(status)
+
+    def send(self, record):
+        self.sock.sendall((json.dumps(record) + "\n").encode("utf-8"))
+
+
+def worker(listener, max_jobs, free):
+    """The loop of a worker of the pool: serve connections until max_jobs
+       jobs were run, then exit to be replaced by a fresh worker.
+       free is the shared count of the workers waiting for a connection.
+    """
+    jobs = 0
+    while jobs < max_jobs:
+        with free.get_lock():
+            free.value += 1
+        try:
+            sock, _ = listener.accept()
+        finally:
+            with free.get_lock():
+                free.value -= 1
+        try:
+            jobs += Connection(sock, listener, free).serve(max_jobs - jobs)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sock.close()
+
+
+def spawn_worker(listener, max_jobs, free):
+    """Fork a worker of the pool, return its pid"""
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        worker(listener, max_jobs, free)
+    finally:
+        os._exit(0)
+
+
+def sweep():
+    """Delete, every SWEEP_INTERVAL seconds, the sessions in the trash"""
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            names = os.listdir(run.TRASH_DIR)
+        except OSError:
+            continue
+        for name in names:
+            shutil.rmtree(os.path.join(run.TRASH_DIR, name), True)
+
+
+def spawn_sweeper():
+    """Fork the process which empties the trash, return its pid"""
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        sweep()
+    finally:
+        os._exit(0)
+
+
+def serve_pool(workers, max_jobs):
+    """Listen on AGENT_SOCKET, with a pool of the given number of workers,
+       each replaced after running max_jobs jobs.
+    """
+    if os.path.exists(AGENT_SOCKET):
+        os.unlink(AGENT_SOCKET)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(AGENT_SOCKET)
+    os.chmod(AGENT_SOCKET, 0o600)
+    listener.listen(LISTEN_BACKLOG)
+
+    free = multiprocessing.Value('i', 0)
+    pids = set(spawn_worker(listener, max_jobs, free)
+               for _ in range(workers))
+    sweeper = spawn_sweeper()
+
+    def stop(signum, frame):
+        for pid in pids | set([sweeper]):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    while True:
+        pid, _ = os.wait()
+        if pid in pids:
+            pids.remove(pid)
+            pids.add(spawn_worker(listener, max_jobs, free))
+        elif pid == sweeper:
+            sweeper = spawn_sweeper()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=POOL_SIZE,
+                        help='the number of jobs run at the same time')
+    parser.add_argument('--max-jobs', type=int, default=MAX_JOBS_PER_WORKER,
+                        help='the number of jobs after which a worker is '
+                             'replaced')
+    args = parser.parse_args()
+
+    # This is where the compiler is installed
+    os.environ["PATH"] = "/gnat/bin:{}".format(os.environ["PATH"])
+
+    serve_pool(args.workers, args.max_jobs)
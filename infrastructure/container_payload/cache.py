@@ -0,0 +1,439 @@
+""" Caches shared by all the sessions run in the container.
+
+    Each cache is a Store: a directory of entries, each entry being a
+    directory named after the hash of what it was computed from. Entries
+    are published atomically, evicted in least-recently-used order when
+    the store grows over its size limit, and the hits and misses are
+    counted in the "stats.json" file of the store, along with its size:
+    the store is only walked when it is over its limit.
+
+    BuildCache stores the executables of whole sessions, and ObjectCache
+    the objects of the units, so that a session which is not in the build
+    cache only compiles the units that differ from those already seen.
+    ProofCache stores the output of gnatprove for whole sessions, along
+    with the session data of gnatprove for each project.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+CACHE_ROOT = "/workspace/cache"
+
+BUILD_CACHE_SIZE = 512 * 1024 * 1024
+# The size, in bytes, over which entries are evicted from the build cache
+
+UNKEYED_FILES = ["cli.txt", "lab_io.txt"]
+# The session files which have no effect on the build
+
+OBJECT_CACHE_SIZE = 1024 * 1024 * 1024
+# The size, in bytes, over which entries are evicted from the object cache
+
+PROOF_CACHE_SIZE = 256 * 1024 * 1024
+# The size, in bytes, over which entries are evicted from the proof cache
+
+PROOF_SESSION_CACHE_SIZE = 512 * 1024 * 1024
+# The size, in bytes, over which entries are evicted from the cache of the
+# session data of gnatprove
+
+DEPENDENCY_RE = re.compile(r"^D (\S+)")
+# A dependency line in an ALI file
+
+EXECUTABLE = "executable"
+BUILD_LOG = "build_log.json"
+# The contents of an entry of the build cache
+
+PROOF_LOG = "proof_log.json"
+# The contents of an entry of the proof cache
+
+GNATPROVE_DIR = "gnatprove"
+# The directory in which gnatprove keeps its session data
+
+
+def hash_file(path):
+    """Return the hash of the contents of the given file"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compiler_identity(command):
+    """Return a string identifying the version of the tool run by command"""
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        tool = os.path.join(d, command[0])
+        if os.path.isfile(tool):
+            tool = os.path.realpath(tool)
+            return "{}:{}".format(tool, os.path.getmtime(tool))
+    return command[0]
+
+
+def tree_size(path):
+    """Return the total size of the files under path"""
+    return sum(os.lstat(os.path.join(d, f)).st_size
+               for d, _, files in os.walk(path) for f in files)
+
+
+def hash_files(directory, kind, excluded=()):
+    """Return the hash of the regular files in directory, and of kind"""
+    h = hashlib.sha256(kind)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name in excluded or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            contents = f.read()
+        h.update("\0{}\0{}\0".format(name, len(contents)))
+        h.update(contents)
+    return h.hexdigest()
+
+
+class Store(object):
+
+    def __init__(self, name, max_size):
+        self.root = os.path.join(CACHE_ROOT, name)
+        self.max_size = max_size
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def lookup(self, key):
+        """Return the directory of the entry for key, None if there is
+           none. The entry is marked as recently used.
+        """
+        entry = os.path.join(self.root, key)
+        try:
+            os.utime(entry, None)
+        except OSError:
+            self.count("misses")
+            return None
+        self.count("hits")
+        return entry
+
+    def publish(self, key, populate):
+        """Create the entry for key: populate is called with the name of a
+           directory in which to write the contents of the entry.
+        """
+        self.create(os.path.join(self.root, key), populate)
+
+    def replace(self, key, populate):
+        """Like publish, replacing the entry for key if there is one"""
+        entry = os.path.join(self.root, key)
+        old = tempfile.mkdtemp(dir=self.root, prefix=".")
+        try:
+            os.rename(entry, os.path.join(old, key))
+        except OSError:
+            # There is no entry for key
+            pass
+        else:
+            self.grow(-tree_size(old))
+        self.create(entry, populate)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def create(self, target, populate):
+        """Create the directory target atomically, populate being called
+           with the name of a directory in which to write its contents.
+        """
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".")
+        try:
+            populate(tmp)
+            size = tree_size(tmp)
+            os.rename(tmp, target)
+        except OSError:
+            # Another session has published the same entry in the meantime
+            pass
+        else:
+            self.grow(size)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+    def grow(self, size):
+        """Account for size more bytes in the store, evicting entries if it
+           is now over its size limit.
+        """
+        if "size" not in self.stats() or \
+                self.count("size", size) > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits in
+           its size limit, and record its size.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            entry = os.path.join(self.root, key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = tree_size(entry)
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+        self.update_stats(lambda stats: stats.update(size=total))
+
+    def count(self, counter, amount=1):
+        """Add amount to the given counter in the stats of the store, and
+           return its new value.
+        """
+        def change(stats):
+            stats[counter] = stats.get(counter, 0) + amount
+
+        return self.update_stats(change)[counter]
+
+    def update_stats(self, change):
+        """Apply change to the stats of the store under its lock, and
+           return them.
+        """
+        with open(os.path.join(self.root, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.stats()
+            change(stats)
+            stats["updated"] = time.time()
+            with open(os.path.join(self.root, "stats.json"), "w") as f:
+                json.dump(stats, f)
+        return stats
+
+    def stats(self):
+        """Return the counters of the store"""
+        try:
+            with open(os.path.join(self.root, "stats.json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+class BuildCache(Store):
+    """The executables built by gprbuild, with the output of the build"""
+
+    def __init__(self):
+        super(BuildCache, self).__init__("build", BUILD_CACHE_SIZE)
+
+    def key(self, workdir, command):
+        """Return the key of the build of workdir with command. This must be
+           called once the project file is doctored.
+        """
+        return hash_files(workdir,
+                          " ".join(command) + compiler_identity(command),
+                          UNKEYED_FILES)
+
+    def fetch(self, key, executable):
+        """If there is an entry for key, copy its executable to the given
+           file name and return the records of its build log, otherwise
+           return None.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        try:
+            shutil.copy2(os.path.join(entry, EXECUTABLE), executable)
+            with open(os.path.join(entry, BUILD_LOG)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # The entry was evicted in the meantime
+            return None
+
+    def store(self, key, executable, log):
+        """Store the given executable, built with the records in log"""
+        def populate(tmp):
+            shutil.copy2(executable, os.path.join(tmp, EXECUTABLE))
+            with open(os.path.join(tmp, BUILD_LOG), "w") as f:
+                json.dump(log, f)
+
+        self.publish(key, populate)
+
+
+class ObjectCache(Store):
+    """The objects and ALI files of the Ada units compiled by gprbuild.
+
+       There is one entry per unit source and compilation settings. Since
+       the objects also depend on the other units of the session, an entry
+       contains one variant per set of dependencies, each with the hashes
+       of the session files the unit depends on, as listed in its ALI file.
+    """
+
+    def __init__(self, workdir, command):
+        """Prepare to cache the units of workdir, built with command. This
+           must be called once the project file is doctored.
+        """
+        super(ObjectCache, self).__init__("objects", OBJECT_CACHE_SIZE)
+        self.workdir = workdir
+        h = hashlib.sha256(" ".join(command))
+        h.update(compiler_identity(command))
+        for name in ["main.gpr", "main.adc"]:
+            path = os.path.join(workdir, name)
+            if os.path.isfile(path):
+                h.update(hash_file(path))
+        self.settings = h.hexdigest()
+        self.hashes = {}  # the hashes of the session files, by name
+
+    def file_hash(self, name):
+        """Return the hash of the given session file, None if there is no
+           such file.
+        """
+        if name not in self.hashes:
+            path = os.path.join(self.workdir, name)
+            self.hashes[name] = hash_file(path) if os.path.isfile(path) \
+                else None
+        return self.hashes[name]
+
+    def units(self):
+        """Return the (unit, source) pairs of the session, where unit is the
+           base name of the objects, and source the name of the file which
+           identifies the unit.
+        """
+        result = []
+        for name in sorted(os.listdir(self.workdir)):
+            unit, ext = os.path.splitext(name)
+            if ext == ".adb" or (ext == ".ads" and not os.path.isfile(
+                    os.path.join(self.workdir, unit + ".adb"))):
+                if not unit.startswith("b__"):
+                    result.append((unit, name))
+        return result
+
+    def unit_key(self, source):
+        h = hashlib.sha256(self.settings)
+        h.update(source)
+        h.update(self.file_hash(source))
+        return h.hexdigest()
+
+    def restore(self):
+        """Copy the cached objects of the units of the session to the
+           session. Return the number of units restored.
+        """
+        restored = 0
+        for unit, source in self.units():
+            entry = self.lookup(self.unit_key(source))
+            if entry is None:
+                continue
+            for variant in os.listdir(entry):
+                try:
+                    with open(os.path.join(entry, variant, "deps.json")) as f:
+                        deps = json.load(f)
+                    if all(self.file_hash(name) == h for name, h in deps):
+                        for ext in [".o", ".ali"]:
+                            shutil.copy2(
+                                os.path.join(entry, variant, unit + ext),
+                                self.workdir)
+                        restored += 1
+                        break
+                except (IOError, OSError, ValueError):
+                    # The entry was evicted in the meantime
+                    pass
+        return restored
+
+    def publish_units(self):
+        """Store the objects of the units of the session, after a
+           successful build.
+        """
+        for unit, source in self.units():
+            ali = os.path.join(self.workdir, unit + ".ali")
+            obj = os.path.join(self.workdir, unit + ".o")
+            if not (os.path.isfile(ali) and os.path.isfile(obj)):
+                continue
+
+            deps = []
+            with open(ali) as f:
+                for line in f:
+                    match = DEPENDENCY_RE.match(line)
+                    if match and self.file_hash(match.group(1)):
+                        deps.append((match.group(1),
+                                     self.file_hash(match.group(1))))
+            variant = hashlib.sha256(json.dumps(sorted(deps))).hexdigest()
+
+            entry = os.path.join(self.root, self.unit_key(source))
+            if os.path.isdir(os.path.join(entry, variant)):
+                continue
+
+            def populate(tmp):
+                for path in [ali, obj]:
+                    shutil.copy2(path, tmp)
+                with open(os.path.join(tmp, "deps.json"), "w") as f:
+                    json.dump(deps, f)
+
+            try:
+                os.mkdir(entry)
+            except OSError:
+                # The entry exists already: add the variant to it
+                pass
+            self.create(os.path.join(entry, variant), populate)
+
+
+class ProofCache(Store):
+    """The output and exit status of gnatprove on whole sessions.
+
+       The session data of gnatprove is also kept for each project, that is
+       for each set of file names, so that a session which changes some of
+       the files of a project starts from the data of its previous proof.
+    """
+
+    def __init__(self, workdir, command):
+        """Prepare to cache the proof of workdir with command. This must be
+           called once the project file is doctored.
+        """
+        super(ProofCache, self).__init__("proofs", PROOF_CACHE_SIZE)
+        self.sessions = Store("proof_sessions", PROOF_SESSION_CACHE_SIZE)
+        self.workdir = workdir
+        settings = " ".join(command) + compiler_identity(command)
+        self.key = hash_files(workdir, settings, UNKEYED_FILES)
+
+        h = hashlib.sha256(settings)
+        for name in sorted(os.listdir(workdir)):
+            if name not in UNKEYED_FILES and \
+                    os.path.isfile(os.path.join(workdir, name)):
+                h.update(name + "\0")
+        self.project = h.hexdigest()
+
+    def fetch(self):
+        """Return the (status, records) of the proof of the session if it
+           is in the cache, None otherwise.
+        """
+        entry = self.lookup(self.key)
+        if entry is None:
+            return None
+        try:
+            with open(os.path.join(entry, PROOF_LOG)) as f:
+                result = json.load(f)
+            return result["status"], result["log"]
+        except (IOError, ValueError, KeyError):
+            # The entry was evicted in the meantime
+            return None
+
+    def store(self, status, log):
+        """Store the result of the proof of the session"""
+        def populate(tmp):
+            with open(os.path.join(tmp, PROOF_LOG), "w") as f:
+                json.dump({"status": status, "log": log}, f)
+
+        self.publish(self.key, populate)
+
+    def restore_session(self):
+        """Copy the last session data of gnatprove for the project to the
+           session.
+        """
+        entry = self.sessions.lookup(self.project)
+        if entry is not None:
+            try:
+                shutil.copytree(os.path.join(entry, GNATPROVE_DIR),
+                                os.path.join(self.workdir, GNATPROVE_DIR))
+            except (IOError, OSError, shutil.Error):
+                # The entry was replaced or evicted in the meantime
+                shutil.rmtree(os.path.join(self.workdir, GNATPROVE_DIR),
+                              ignore_errors=True)
+
+    def save_session(self):
+        """Keep the session data of gnatprove for the project"""
+        data = os.path.join(self.workdir, GNATPROVE_DIR)
+        if os.path.isdir(data):
+            self.sessions.replace(
+                self.project,
+                lambda tmp: shutil.copytree(
+                    data, os.path.join(tmp, GNATPROVE_DIR), symlinks=True))
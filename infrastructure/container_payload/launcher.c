@@ -0,0 +1,306 @@
+/* The launcher of user programs in the container.
+
+   This replaces "sudo -u unprivileged timeout 10s bash -c ..." with a
+   single exec: installed setuid root and executable by the group "runner"
+   only, it drops to the user "unprivileged", applies resource limits, and
+   execs the program directly with the preloader that prevents forks.
+
+   Usage:
+      launcher [options] program [args...]
+
+   Options:
+      -t seconds    wall-clock time limit (default 10)
+      -c seconds    CPU time limit (default 10)
+      -m bytes      address space limit (default 1 GiB)
+      -o bytes      limit on the output, stdout and stderr together
+                    (default 16 MiB)
+      -p count      limit on the processes and threads of unprivileged
+                    (default 1024)
+
+   The output of the program is relayed by the launcher. The exit status
+   is that of the program, 128 + the signal if it was killed by a signal,
+   or 124 (as with timeout) when it was interrupted for exceeding the time
+   or output limits.
+
+   If the launcher itself stops being read, that is as soon as its output
+   is closed, or if it dies, the program is killed: this is how runner,
+   which cannot signal the processes of unprivileged, stops a program. */
+
+#include <errno.h>
+#include <grp.h>
+#include <poll.h>
+#include <pwd.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/time.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+#define UNPRIVILEGED "unprivileged"
+#define PRELOADER "LD_PRELOAD=/preloader.so"
+#define INTERRUPT_STATUS 124
+
+static long wall_limit = 10;
+static long cpu_limit = 10;
+static long memory_limit = 1024L * 1024 * 1024;
+static long output_limit = 16L * 1024 * 1024;
+static long process_limit = 1024;
+
+static char *environment[] = {
+  "PATH=/usr/bin:/bin",
+  "HOME=/home/unprivileged",
+  PRELOADER,
+  NULL
+};
+
+static void
+fail (const char *what)
+{
+  perror (what);
+  exit (INTERRUPT_STATUS + 1);
+}
+
+static double
+now (void)
+{
+  struct timespec ts;
+  clock_gettime (CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Drop all the privileges, becoming the user "unprivileged" */
+
+static void
+drop_privileges (void)
+{
+  struct passwd *pw = getpwnam (UNPRIVILEGED);
+
+  if (pw == NULL)
+    fail ("getpwnam");
+  if (setgroups (0, NULL) != 0
+      || setgid (pw->pw_gid) != 0
+      || setuid (pw->pw_uid) != 0)
+    fail ("dropping privileges");
+  if (setuid (0) == 0)
+    {
+      fprintf (stderr, "launcher: privileges were not dropped\n");
+      exit (INTERRUPT_STATUS + 1);
+    }
+}
+
+static void
+set_limit (int resource, rlim_t value)
+{
+  struct rlimit rl;
+
+  rl.rlim_cur = rl.rlim_max = value;
+  if (setrlimit (resource, &rl) != 0)
+    fail ("setrlimit");
+}
+
+/* Write all of buf to fd, return 0 on success */
+
+static int
+write_all (int fd, const char *buf, ssize_t len)
+{
+  while (len > 0)
+    {
+      ssize_t n = write (fd, buf, len);
+
+      if (n < 0)
+        {
+          if (errno == EINTR)
+            continue;
+          return -1;
+        }
+      buf += n;
+      len -= n;
+    }
+  return 0;
+}
+
+/* Run argv with the limits, relaying its output. Return the exit status
+   as described above. */
+
+static int
+run (char **argv)
+{
+  int out[2], err[2];
+  /* The output of the program, then our own, watched for being closed */
+  struct pollfd fds[4];
+  int open_fds = 2;
+  pid_t parent = getpid ();
+  long output = 0;
+  int interrupted = 0;
+  double deadline = now () + wall_limit;
+  pid_t pid;
+  int status;
+  char buf[8192];
+
+  if (pipe (out) != 0 || pipe (err) != 0)
+    fail ("pipe");
+
+  pid = fork ();
+  if (pid < 0)
+    fail ("fork");
+
+  if (pid == 0)
+    {
+      /* Die with the launcher */
+      if (prctl (PR_SET_PDEATHSIG, SIGKILL) != 0)
+        fail ("prctl");
+      if (getppid () != parent)
+        _exit (INTERRUPT_STATUS);
+
+      if (dup2 (out[1], 1) < 0 || dup2 (err[1], 2) < 0)
+        fail ("dup2");
+      close (out[0]);
+      close (out[1]);
+      close (err[0]);
+      close (err[1]);
+
+      set_limit (RLIMIT_CPU, cpu_limit);
+      set_limit (RLIMIT_AS, memory_limit);
+      set_limit (RLIMIT_FSIZE, output_limit);
+      set_limit (RLIMIT_NPROC, process_limit);
+      set_limit (RLIMIT_CORE, 0);
+
+      execve (argv[0], argv, environment);
+      fail (argv[0]);
+    }
+
+  close (out[1]);
+  close (err[1]);
+  fds[0].fd = out[0];
+  fds[1].fd = err[0];
+  fds[0].events = fds[1].events = POLLIN;
+  fds[2].fd = 1;
+  fds[3].fd = 2;
+  fds[2].events = fds[3].events = 0;
+
+  while (open_fds > 0 && !interrupted)
+    {
+      int remaining = (int) ((deadline - now ()) * 1000);
+      int i;
+
+      if (remaining <= 0)
+        {
+          interrupted = 1;
+          break;
+        }
+
+      if (poll (fds, 4, remaining) < 0)
+        {
+          if (errno == EINTR)
+            continue;
+          fail ("poll");
+        }
+
+      for (i = 0; i < 2; i++)
+        {
+          ssize_t n;
+
+          if (fds[i].fd < 0 || !(fds[i].revents & (POLLIN | POLLHUP | POLLERR)))
+            continue;
+
+          n = read (fds[i].fd, buf, sizeof (buf));
+          if (n <= 0)
+            {
+              close (fds[i].fd);
+              fds[i].fd = -1;
+              open_fds--;
+              continue;
+            }
+
+          if (output + n > output_limit)
+            {
+              n = output_limit - output;
+              interrupted = 1;
+            }
+          output += n;
+
+          /* If nobody reads us anymore, stop the program */
+          if (write_all (i + 1, buf, n) != 0)
+            interrupted = 1;
+        }
+
+      /* Likewise if our output is closed, without waiting for the next
+         write */
+      for (i = 2; i < 4; i++)
+        {
+          if (fds[i].revents & POLLNVAL)
+            fds[i].fd = -1;
+          else if (fds[i].revents & (POLLERR | POLLHUP))
+            interrupted = 1;
+        }
+    }
+
+  if (interrupted)
+    kill (pid, SIGKILL);
+
+  if (fds[0].fd >= 0)
+    close (fds[0].fd);
+  if (fds[1].fd >= 0)
+    close (fds[1].fd);
+
+  while (waitpid (pid, &status, 0) < 0)
+    if (errno != EINTR)
+      fail ("waitpid");
+
+  if (interrupted)
+    return INTERRUPT_STATUS;
+  if (WIFSIGNALED (status))
+    return 128 + WTERMSIG (status);
+  return WEXITSTATUS (status);
+}
+
+int
+main (int argc, char **argv)
+{
+  int opt;
+
+  while ((opt = getopt (argc, argv, "+t:c:m:o:p:")) != -1)
+    {
+      switch (opt)
+        {
+        case 't':
+          wall_limit = atol (optarg);
+          break;
+        case 'c':
+          cpu_limit = atol (optarg);
+          break;
+        case 'm':
+          memory_limit = atol (optarg);
+          break;
+        case 'o':
+          output_limit = atol (optarg);
+          break;
+        case 'p':
+          process_limit = atol (optarg);
+          break;
+        default:
+          fprintf (stderr, "usage: launcher [-t s] [-c s] [-m bytes] "
+                   "[-o bytes] [-p count] program [args...]\n");
+          return INTERRUPT_STATUS + 1;
+        }
+    }
+
+  if (optind >= argc)
+    {
+      fprintf (stderr, "launcher: no program given\n");
+      return INTERRUPT_STATUS + 1;
+    }
+
+  /* Writing to a closed pipe must fail rather than kill us, so that the
+     program gets killed */
+  signal (SIGPIPE, SIG_IGN);
+
+  drop_privileges ();
+
+  return run (argv + optind);
+}
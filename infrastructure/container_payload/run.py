@@ -3,32 +3,86 @@
 """ This is a standalone Python script that runs its argument
     safely in a container.
 
-    At the moment it assumes that the container "safecontainer"
-    exists and is running.
+    At the moment it assumes that the container "safecontainer", or the
+    one named by the environment variable SAFECONTAINER, exists and is
+    running.
 """
 
 import io
 import re
 import os
+import select
 import codecs
 import json
 import glob
 import time
 import sys
+import socket
 import subprocess
+import threading
 import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
-CONT = 'safecontainer'
+import cache
+
+CONT = os.environ.get('SAFECONTAINER', 'safecontainer')
 INTERRUPT_STRING = '<interrupted>'
 INTERRUPT_RETURNCODE = 124
 DEBUG = False
 
 CLI_FILE = "cli.txt"
 
+LAUNCHER = "/launcher"
+# The setuid helper, built from launcher.c, that runs user programs
+
+RUN_TIMEOUT = 10
+# The time limit, in seconds, of a run of the user program
+
+SESSIONS_DIR = "/workspace/sessions"
+
+TRASH_DIR = "/workspace/trash"
+# The dir to which the finished sessions are moved, to be deleted later by
+# the sweeper of agent.py, or by cleanup_sessions.sh if there is no agent
+
+POOL_SOCKET = "/workspace/agent.sock"
+# The socket of the pool of workers of agent.py
+
 LAB_IO_FILE = "lab_io.txt"
 
 LAB_IO_REGEX = re.compile("(in|out) ?(\d+):(.*)")
 
+LAB_PARALLELISM = 4
+# The number of lab test cases run at the same time
+
+LAB_FAIL_FAST = False
+# Whether to skip the remaining lab test cases once one has failed
+
+OUTPUT_MAX_LINES = 5000
+# The number of lines of output of a session printed in full
+
+OUTPUT_MAX_BYTES = 1024 * 1024
+# The number of bytes of output of a session printed in full
+
+OUTPUT_TAIL_LINES = 100
+# The number of the last lines of a command printed once the above are
+# exceeded
+
+OUTPUT_LINE_LENGTH = 4096
+# The length beyond which a line of output is split
+
+ELIDED_STRING = "<{} lines elided>"
+# The message printed in place of the lines of output which were not kept
+
+READ_SIZE = 65536
+# The maximum number of bytes read at once from the output of a command
+
+FLUSH_INTERVAL = 0.05
+# The maximum number of seconds during which printed records are buffered
+
+FLUSH_RECORDS = 64
+# The number of printed records after which they are flushed
+
 
 COMMON_ADC = """
 pragma Restrictions (No_Specification_of_Aspect => Import);
@@ -55,8 +109,17 @@ procedure_re = re.compile("^procedure +[A-Za-z][_a-zA-Z0-9]*[ |\n]+(is|with)", r
 ########################
 
 
+output = threading.local()
+# The records printed by a thread go to output.sink instead of stdout when
+# this is set to a list
+
+
 def json_print(pdict):
-    print(json.dumps(pdict))
+    sink = getattr(output, "sink", None)
+    if sink is not None:
+        sink.append(pdict)
+    else:
+        print(json.dumps(pdict))
 
 
 def print_generic(msg, tag, lab_ref):
@@ -91,6 +154,75 @@ def debug_print(str):
 def print_internal_error(msg, lab_ref=None):
     print_generic(msg, "internal_error", lab_ref)
 
+def decode(msg):
+    """Return msg as unicode, for storage"""
+    return msg.decode(encoding='utf-8', errors='replace')
+
+
+class OutputBudget(object):
+    """The output that a session may still print in full. It is shared by
+       the commands of the session, which may run at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = OUTPUT_MAX_LINES
+        self.size = OUTPUT_MAX_BYTES
+
+    def take(self, line):
+        """Count line against the budget, return False if it does not fit"""
+        with self.lock:
+            if self.lines <= 0 or len(line) > self.size:
+                self.lines = 0
+                return False
+            self.lines -= 1
+            self.size -= len(line)
+            return True
+
+
+def split_lines(data):
+    """Split data into its complete lines, splitting those longer than
+       OUTPUT_LINE_LENGTH.
+       Return a tuple (lines, rest) where rest is the incomplete last line,
+       and lines a list of pairs (line, end) where end is whether the line
+       ends there rather than being continued by the next one.
+    """
+    lines = data.split('\n')
+    rest = lines.pop()
+    result = []
+    for line in lines:
+        while len(line) > OUTPUT_LINE_LENGTH:
+            result.append((line[:OUTPUT_LINE_LENGTH], False))
+            line = line[OUTPUT_LINE_LENGTH:]
+        result.append((line, True))
+    while len(rest) > OUTPUT_LINE_LENGTH:
+        result.append((rest[:OUTPUT_LINE_LENGTH], False))
+        rest = rest[OUTPUT_LINE_LENGTH:]
+    return result, rest
+
+
+def replay(log, returncode):
+    """Print the (tag, message) records of a cached command, and return
+       the result of c() for this command.
+    """
+    for tag, msg in log:
+        print_generic(msg.encode('utf-8'), tag, None)
+    sys.stdout.flush()
+    return (True, [msg.encode('utf-8') + '\n'
+                   for tag, msg in log if tag == "stdout"], returncode)
+
+
+def open_cache(cls, *args):
+    """Return an instance of the given cache class, created with args, None
+       if the cache cannot be used.
+    """
+    try:
+        return cls(*args)
+    except (IOError, OSError):
+        debug_print(traceback.format_exc())
+        return None
+
+
 def run(command):
     debug_print(">{}".format(" ".join(command)))
     output = subprocess.check_output(["lxc", "exec", CONT, "--"] + command)
@@ -185,11 +317,19 @@ def doctor_main_gpr(tempd, spark_mode=False):
 
 def safe_run(workdir, mode, lab):
 
-    def c(cl=[], lab_ref=None):
+    budget = OutputBudget()
+
+    def c(cl=[], lab_ref=None, record=None, check=None):
         """Aux procedure, run the given command line and output to stdout.
 
         Parameters:
         cl (list): The command list to be sent to popen
+        record (list): If given, the (tag, message) pairs printed are
+                       appended to it
+        check (function): If given, called with the list of the stdout
+                          lines after each line: the command is stopped as
+                          soon as it returns False. The lines are all
+                          there, whether they were printed or not
 
         Returns:
         tuple: of (Boolean success, list stdout, int returncode).
@@ -197,30 +337,98 @@ def safe_run(workdir, mode, lab):
 
         stdout_list = []
         p = None
+        stopped = False
+
+        # Past the budget of the session, only the last lines are kept, and
+        # printed at the end after the number of lines left out
+        tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        elided = [0]
+
+        def show(tag, line):
+            print_generic(line, tag, lab_ref)
+            if record is not None:
+                record.append((tag, decode(line)))
+
+        def emit(tag, line, end=True):
+            if tag == "stdout":
+                # The pieces of a line split for display are joined back
+                if stdout_list and not stdout_list[-1].endswith('\n'):
+                    stdout_list[-1] += line
+                else:
+                    stdout_list.append(line)
+                if end:
+                    stdout_list[-1] += '\n'
+
+            if elided[0] == 0 and budget.take(line):
+                show(tag, line)
+            else:
+                tail.append((tag, line))
+                elided[0] += 1
+
         try:
             debug_print("running: {}".format(cl))
 
             p = subprocess.Popen(cl, cwd=workdir,
                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-            while True:
-                stdout_line = p.stdout.readline().replace(workdir, '.')
 
-                if stdout_line:
-                    print_stdout(stdout_line.rstrip(), lab_ref)
-                    stdout_list.append(stdout_line)
+            # Read stdout and stderr as their output comes, keeping the
+            # incomplete last line of each
+            streams = {p.stdout.fileno(): ["stdout", ""],
+                       p.stderr.fileno(): ["stderr", ""]}
+            poller = select.poll()
+            for fd in streams:
+                poller.register(fd, select.POLLIN | select.POLLHUP)
+
+            # The records are flushed in batches
+            unflushed = 0
+            flush_time = time.time() + FLUSH_INTERVAL
+
+            while streams and not stopped:
+                timeout = None
+                if unflushed:
+                    timeout = int(max(0, flush_time - time.time()) * 1000) + 1
+
+                for fd, event in poller.poll(timeout):
+                    tag, partial = streams[fd]
+                    data = os.read(fd, READ_SIZE)
+                    if data:
+                        lines, streams[fd][1] = split_lines(partial + data)
+                    else:
+                        poller.unregister(fd)
+                        del streams[fd]
+                        lines = [(partial, True)] if partial else []
+
+                    for line, end in lines:
+                        emit(tag, line.replace(workdir, '.').rstrip('\r\n'),
+                             end)
+                        unflushed += 1
+
+                        if tag == "stdout" and check is not None and \
+                                not check(stdout_list):
+                            stopped = True
+                            stop(p)
+                            break
+
+                    if stopped:
+                        break
+
+                if unflushed and (unflushed >= FLUSH_RECORDS or
+                                  time.time() >= flush_time):
                     sys.stdout.flush()
+                    unflushed = 0
+                    flush_time = time.time() + FLUSH_INTERVAL
 
-                if not (stdout_line):
-                    p.poll()
-                    break
+            p.wait()
 
-            for line in iter(p.stderr.readline, b''):
-                print_stderr(line.replace(workdir, '.').rstrip(), lab_ref)
+            if elided[0] > len(tail):
+                show("stderr", ELIDED_STRING.format(elided[0] - len(tail)))
+            for tag, line in tail:
+                show(tag, line)
 
             sys.stdout.flush()
             sys.stderr.flush()
 
-            if p.returncode == INTERRUPT_RETURNCODE:
+            if p.returncode == INTERRUPT_RETURNCODE and not stopped:
                 print_stderr(INTERRUPT_STRING, lab_ref)
             return True, stdout_list, p.returncode
         except Exception:
@@ -228,11 +436,28 @@ def safe_run(workdir, mode, lab):
             print_stderr(traceback.format_exc(), lab_ref)
             return False, stdout_list, (p.returncode if p else 404)
 
-    def build(extra_args):
+    def stop(p):
+        """Stop the process p started by c()"""
+        # The program runs as unprivileged, which we cannot signal: closing
+        # its pipes makes it, or the launcher, fail on its next write
+        p.stdout.close()
+        p.stderr.close()
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+    def build(extra_args, main):
         """Builds command string to build the application and passes that to c()
 
+        The executable is taken from the build cache if the same sources were
+        built already, in which case the output of the build is replayed.
+        Otherwise the objects of the units found in the object cache are
+        reused.
+
         Parameters:
         extra_args (list): The extra build arguments to be passed to the build
+        main (string): The name of the main, empty if there is none
 
         Returns:
         tuple: of (Boolean success, list stdout, returncode).
@@ -241,15 +466,46 @@ def safe_run(workdir, mode, lab):
         line = ["gprbuild", "-q", "-P", "main", "-gnatwa"]
         line.extend(extra_args)
         print_console(line)
-        return c(line)
 
-    def run(main, workdir, arg_list, lab_ref=None):
+        build_cache = open_cache(cache.BuildCache) if main else None
+        if build_cache:
+            executable = os.path.join(workdir, main.split('.')[0])
+            key = build_cache.key(workdir, line)
+            log = build_cache.fetch(key, executable)
+            if log is not None:
+                return replay(log, 0)
+
+        # Start from the objects of the units already compiled in other
+        # sessions: -m makes gprbuild compare the sources with their
+        # checksums rather than their timestamps, which differ
+        build_line = line
+        objects = open_cache(cache.ObjectCache, workdir, line)
+        try:
+            if objects and objects.restore():
+                build_line = line + ["-m"]
+        except (IOError, OSError):
+            debug_print(traceback.format_exc())
+
+        log = []
+        result = c(build_line, record=log)
+        if result[2] == 0:
+            try:
+                if build_cache and os.path.isfile(executable):
+                    build_cache.store(key, executable, log)
+                if objects:
+                    objects.publish_units()
+            except (IOError, OSError):
+                debug_print(traceback.format_exc())
+        return result
+
+    def run(main, workdir, arg_list, lab_ref=None, check=None):
         """Builds command string to run the application and passes that to c()
 
         Parameters:
         main (string): The name of the main
         workdir (string): The path of the working directory
         arg_list (list): The arguments to be passed to the main
+        check (function): See c()
 
         Returns:
         tuple: of (Boolean success, list stdout, returncode).
@@ -259,17 +515,25 @@ def safe_run(workdir, mode, lab):
         #  - as user 'unprivileged' that has no write access
         #  - under a timeout
         #  - with our ld preloader to prevent forks
-        line = ['sudo', '-u', 'unprivileged', 'timeout', '10s',
-                'bash', '-c',
-                'LD_PRELOAD=/preloader.so {} {}'.format(
-                   os.path.join(workdir, main.split('.')[0]), "`echo {}`".format(" ".join(arg_list)))]
+        program = os.path.join(workdir, main.split('.')[0])
+        if os.path.isfile(LAUNCHER):
+            line = [LAUNCHER, '-t', str(RUN_TIMEOUT), program] + arg_list
+        else:
+            line = ['sudo', '-u', 'unprivileged',
+                    'timeout', '{}s'.format(RUN_TIMEOUT),
+                    'bash', '-c',
+                    'LD_PRELOAD=/preloader.so {} {}'.format(
+                       program, "`echo {}`".format(" ".join(arg_list)))]
         print_list = []
         print_console(["./{}".format(main)] + arg_list, lab_ref)
-        return c(line, lab_ref)
+        return c(line, lab_ref, check=check)
 
     def prove(extra_args):
         """Builds command string to prove the application and passes that to c()
 
+        The output is taken from the proof cache if the same sources were
+        proved already with the same arguments.
+
         Parameters:
         extra_args (list): The extra gnatprove arguments to be passed to the prover
 
@@ -281,17 +545,36 @@ def safe_run(workdir, mode, lab):
                 "--level=0", "--no-axiom-guard"]
         line.extend(extra_args)
         print_console(line)
-        return c(line)
 
-    # This is necessary to get the first line from the container. Otherwise
-    # the first line is lost.
-    c(["echo"])
+        proof_cache = open_cache(cache.ProofCache, workdir, line)
+        if not proof_cache:
+            return c(line)
+
+        try:
+            cached = proof_cache.fetch()
+            if cached is not None:
+                return replay(cached[1], cached[0])
+            proof_cache.restore_session()
+        except (IOError, OSError):
+            debug_print(traceback.format_exc())
+
+        log = []
+        result = c(line, record=log)
+        if result[0] and result[2] is not None and result[2] >= 0 and \
+                result[2] != INTERRUPT_RETURNCODE:
+            try:
+                proof_cache.store(result[2], log)
+                proof_cache.save_session()
+            except (IOError, OSError):
+                debug_print(traceback.format_exc())
+        return result
+
     try:
         if mode == "run" or mode == "submit":
             main = doctor_main_gpr(workdir, False)
 
             # In "run" or "submit" mode, build, and then launch the main
-            if build([])[2] == 0 and main:
+            if build([], main)[2] == 0 and main:
                 if mode == "run":
                     # Check to see if cli.txt was sent from the front-end
                     cli_txt = os.path.join(workdir, CLI_FILE)
@@ -331,19 +614,48 @@ def safe_run(workdir, mode, lab):
                                 else:
                                     test_cases[key] = {io: seq}
 
-                        # Loop over IO resources and run all instances in sorted order by test case number
-                        success = True
+                        # check that all test cases have defined ins and outs
                         for index, test in sorted(test_cases.items()):
-                            # check that this test case has defined ins and outs
-                            if "in" in test.keys() and "out" in test.keys():
-
-                                errno, stdout, retcode = run(main, workdir, test["in"].split(), index)
-                                test["actual"] = " ".join(stdout).replace('\n', '').replace('\r', '')
+                            if "in" not in test.keys() or "out" not in test.keys():
+                                print_internal_error("Malformed test IO sequence in test case #{}.".format(index), index)
+                                sys.exit(1)
 
-                                if retcode is not None and retcode != 0:
+                        cancelled = threading.Event()
+
+                        def run_test_case(item):
+                            """Run one test case, return the records it printed"""
+                            index, test = item
+                            records = []
+                            output.sink = records
+                            try:
+                                if cancelled.is_set():
+                                    print_stderr("Not run after a previous test case failed.", index)
+                                    # The same fields as for the cases which were run
+                                    test["actual"] = None
+                                    test["status"] = "Cancelled"
+                                    test["cancelled"] = True
+                                    return records
+
+                                diverged = []
+
+                                def check(stdout):
+                                    """Return False once stdout cannot give the expected output"""
+                                    if test["out"].startswith(lab_output(stdout)):
+                                        return True
+                                    diverged.append(True)
+                                    return False
+
+                                test["cancelled"] = False
+                                errno, stdout, retcode = run(main, workdir, test["in"].split(), index, check)
+                                test["actual"] = lab_output(stdout)
+
+                                if diverged:
+                                    matched = os.path.commonprefix([test["actual"], test["out"]])
+                                    print_stderr("Program output ({}) does not match expected output ({}), stopped after the matching prefix ({}).".format(test["actual"], test["out"], matched), index)
+                                    test["status"] = "Failed"
+                                elif retcode is not None and retcode != 0:
                                     print_stderr("Process returned non-zero result: {}".format(retcode), index)
                                     test["status"] = "Failed"
-                                    success = False
                                 else:
 
                                     if test["actual"] == test["out"]:
@@ -351,10 +663,24 @@ def safe_run(workdir, mode, lab):
                                     else:
                                         print_stderr("Program output ({}) does not match expected output ({}).".format(test["actual"], test["out"]), index)
                                         test["status"] = "Failed"
-                                        success = False
-                            else:
-                                print_internal_error("Malformed test IO sequence in test case #{}.".format(index), index)
-                                sys.exit(1)
+
+                                if test["status"] != "Success" and LAB_FAIL_FAST:
+                                    cancelled.set()
+                            finally:
+                                output.sink = None
+                            return records
+
+                        # Run the test cases concurrently, and print their output in sorted order by test case number
+                        pool = ThreadPool(LAB_PARALLELISM)
+                        try:
+                            for records in pool.imap(run_test_case, sorted(test_cases.items())):
+                                for record in records:
+                                    json_print(record)
+                                sys.stdout.flush()
+                        finally:
+                            pool.close()
+
+                        success = all(test["status"] == "Success" for test in test_cases.values())
                         print_lab(success, test_cases)
                     else:
                         # No lab IO resources defined. This is an error in the lab config
@@ -378,12 +704,50 @@ def safe_run(workdir, mode, lab):
         traceback.print_exc()
 
     finally:
-        if os.path.isdir(workdir):
-            time.sleep(0.2)  # Time for the filesystem to sync
-            if not DEBUG:
+        if os.path.isdir(workdir) and not DEBUG:
+            # Moving the session out of the way is immediate, unlike
+            # deleting it
+            try:
+                os.rename(workdir,
+                          os.path.join(TRASH_DIR, os.path.basename(workdir)))
+            except OSError:
                 c(["rm", "-rf", workdir])
 
 
+def lab_output(stdout_list):
+    """Return the output of a lab test case, from its list of stdout lines"""
+    return " ".join(stdout_list).replace('\n', '').replace('\r', '')
+
+
+def connect_to_pool():
+    """Return a connection to the pool of workers, None if there is none"""
+    if not os.path.exists(POOL_SOCKET):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(POOL_SOCKET)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+
+def run_in_pool(s, workdir, mode, lab):
+    """Hand the job over to the pool of workers connected with s, printing
+       its output as it comes. Return the exit status of the job.
+    """
+    job = {"identifier": os.path.basename(workdir), "mode": mode, "lab": lab}
+    s.sendall(json.dumps(job) + "\n")
+    for line in iter(s.makefile("rb").readline, b''):
+        if line.startswith('{"status": '):
+            return json.loads(line)["status"]
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    # The pool has gone away before the end of the job
+    return 1
+
+
 if __name__ == '__main__':
     # perform some sanity checking on args - this is not meant to
     # be launched interactively
@@ -402,4 +766,17 @@ if __name__ == '__main__':
     # This is where the compiler is installed
     os.environ["PATH"] = "/gnat/bin:{}".format(os.environ["PATH"])
 
+    # This is necessary to get the first line from the container. Otherwise
+    # the first line is lost.
+    print_stdout("")
+    sys.stdout.flush()
+
+    # Sessions are run by the pool of workers if there is one: they have
+    # this script loaded already
+    pool = None
+    if os.path.dirname(os.path.abspath(workdir)) == SESSIONS_DIR:
+        pool = connect_to_pool()
+    if pool:
+        sys.exit(run_in_pool(pool, workdir, mode, lab))
+
     safe_run(workdir, mode, lab)